@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+# Atomic writing of the generated files. The content is written to a
+# temporary file next to the target, synced to disk and then renamed
+# over it, so a run interrupted while writing never leaves a half
+# written file for the next run (or the browser) to load:
+#
+#   with AtomicFile("{}/locations.py".format(run_path)) as locations_file:
+#       locations_file.write(...)
+#
+#   writeFileIfChanged("{}/user.py".format(run_path), content)
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+import os
+
+
+# ================= CONFIGURATION VARIABLES =====================
+
+# Size of the write buffer, the content is written in chunks of this size
+buffer_size = 1024 * 1024
+
+
+# ===============================================================
+
+class AtomicFile:
+
+    def __init__(self, file_path, mode='w'):
+        self.file_path = file_path
+        self.temp_path = "{}.{}.tmp".format(file_path, os.getpid())
+        self.mode = mode
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.temp_path, self.mode, buffering=buffer_size)
+        return self.file
+
+    # Replace the target if the content was written without errors,
+    # otherwise discard it and keep the target as it was
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            os.replace(self.temp_path, self.file_path)
+        else:
+            self.file.close()
+            os.remove(self.temp_path)
+        return False
+
+
+# Write a file only if its content changed, returns True if it was written
+def writeFileIfChanged(file_path, content):
+    try:
+        with open(file_path) as current_file:
+            if current_file.read() == content:
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    with AtomicFile(file_path) as new_file:
+        new_file.write(content)
+    return True
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+# Checkpoint of the photos extraction phase, so an interrupted run can
+# resume from the last completed page instead of fetching everything
+# again. The file is a journal of json lines: the first one is the
+# cursor identifying the run (user, mode and total), followed by one
+# line per processed page with the photos taken from it:
+#
+#   {"user_id": ..., "mode": ..., "photoset_id": ..., "total": ..., "npages": ...}
+#   {"page": 1, "proc_photos": 500, "photos": [[longitude, latitude, id, url], ...]}
+#
+# Each page line is appended and synced to disk, so saving a page costs
+# only the size of the page. A line cut by a crash is ignored on reload.
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+import json
+import os
+
+
+# ================= CONFIGURATION VARIABLES =====================
+
+checkpoint_file_name = 'checkpoint.jsonl'
+
+
+# ===============================================================
+
+class Checkpoint:
+
+    def __init__(self, run_path, cursor):
+        self.file_path = "{}/{}".format(run_path, checkpoint_file_name)
+        self.cursor = cursor
+        self.file = None
+
+    # Read the pages saved by a previous run with the same cursor,
+    # returns an empty list if there is no checkpoint to resume from
+    def loadPages(self):
+        pages = []
+        if not os.path.exists(self.file_path):
+            return pages
+        with open(self.file_path) as checkpoint_file:
+            lines = checkpoint_file.read().split('\n')
+        try:
+            if json.loads(lines[0]) != self.cursor:
+                return pages
+        except ValueError:
+            return pages
+        for line in lines[1:]:
+            try:
+                page = json.loads(line)
+            except ValueError:
+                break
+            if page.get('page') != len(pages) + 1:
+                break
+            pages.append(page)
+        return pages
+
+    # Start the journal, keeping the pages already saved
+    # in it if they are going to be resumed
+    def open(self, pages=()):
+        self.file = open(self.file_path, 'w')
+        self.file.write("{}\n".format(json.dumps(self.cursor)))
+        for page in pages:
+            self.file.write("{}\n".format(json.dumps(page)))
+        self.sync()
+
+    # Save a processed page, 'info' holds any other
+    # values needed to resume the run after this page
+    def addPage(self, pg, proc_photos, photos, **info):
+        page = {'page': pg, 'proc_photos': proc_photos, 'photos': photos}
+        page.update(info)
+        self.file.write("{}\n".format(json.dumps(page)))
+        self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    # Remove the checkpoint once the map files were written
+    def remove(self):
+        self.close()
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
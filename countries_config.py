@@ -21,6 +21,10 @@ use_mapbox = True
 nominatim_exclude = ['MA', 'BR', 'PY', 'AR']
 geonames_exclude = ['PY', 'AR']
 
+# number of tries on each geocoder before giving up,
+# waits between tries grow exponentially
+geocoder_max_tries = 3
+
 # control if report and errors files will be generated
 gen_err_file = True
 gen_rep_file = True
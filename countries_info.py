@@ -3,12 +3,20 @@
 from geopy.geocoders import Nominatim
 from geopy.geocoders import GeoNames
 from geopy.geocoders import MapBox
+from geopy.exc import GeocoderQueryError
+from geopy.exc import GeocoderAuthenticationFailure
+from geopy.exc import GeocoderInsufficientPrivileges
 
 import os
 import api_credentials
 import countries_config
 import not_found
 
+from rate_limiter import getLimiter
+from retry_policy import RetryPolicy
+from geocode_store import GeocodeStore
+from atomic_file import AtomicFile
+
 try:
     geolocator1 = Nominatim(user_agent=api_credentials.nominatim_agent)
     geolocator2 = GeoNames(username=api_credentials.geonames_user)
@@ -16,6 +24,36 @@ except:
     print("ERROR: FATAL: Unable to get geolocators")
     sys.exit()
 
+# errors that won't be solved by trying again
+def isGeocoderErrorRetryable(error):
+    return not isinstance(error, (GeocoderQueryError, GeocoderAuthenticationFailure, GeocoderInsufficientPrivileges))
+
+geocoder_retry = RetryPolicy(max_tries=countries_config.geocoder_max_tries, retryable=isGeocoderErrorRetryable)
+
+# geocoded coordinates, opened on the first lookup
+geocode_store = None
+
+def getGeocodeStore():
+    global geocode_store
+    if geocode_store is None:
+        geocode_store = GeocodeStore(os.path.dirname(os.path.realpath(__file__)))
+    return geocode_store
+
+# Save the geocoded coordinates not committed yet
+def closeGeocodeStore():
+    global geocode_store
+    if geocode_store is not None:
+        geocode_store.close()
+        geocode_store = None
+
+# Reverse geocode a location waiting for the rate limit of the provider,
+# trying again with backoff and failing fast while its circuit is open
+def reverseGeocode(provider, geolocator, latlong, **params):
+    def reverse():
+        getLimiter(provider).acquire()
+        return geolocator.reverse(latlong, **params)
+    return geocoder_retry.call(provider, reverse)
+
 def isTerritory(lat, long, code):
     try:
         for coords in countries_dict[code][1]:
@@ -25,20 +63,11 @@ def isTerritory(lat, long, code):
         pass
     return True
 
-def getInfoFromDictionary(latlong, dictionary):
-    country_info = ['', '']
-    key = "{},{}".format(latlong[0], latlong[1])
-    try:
-        country_info = dictionary[key]
-    except:
-        pass
-    return country_info
-
 def getInfoFromNominatim(latlong):
     code = ''
     name = ''
     try:
-        location = geolocator1.reverse(latlong, language='en-US', zoom=18, exactly_one=True)
+        location = reverseGeocode('nominatim', geolocator1, latlong, language='en-US', zoom=18, exactly_one=True)
         if location != None:
             code = location.raw['address']['country_code'].upper()
             name = location.raw['address']['country']
@@ -50,7 +79,7 @@ def getInfoFromGeoNames(latlong):
     code = ''
     name = ''
     try:
-        location = geolocator2.reverse(latlong, lang='en-US', exactly_one=True)
+        location = reverseGeocode('geonames', geolocator2, latlong, lang='en-US', exactly_one=True)
         if location != None:
             code = location.raw['countryCode']
             name = location.raw['countryName']
@@ -66,7 +95,7 @@ def getInfoFromMapBox(latlong):
     except:
         return ['**', '']
     try:
-        location = geolocator3.reverse(latlong, exactly_one=True)
+        location = reverseGeocode('mapbox', geolocator3, latlong, exactly_one=True)
         if location != None:
             location_info = location.raw['context']
             len_info = len(location_info)
@@ -83,7 +112,15 @@ def getInfoFromMapBox(latlong):
         name = ''
     return [code, name]
 
-def getCountryInfo(lat, long, matrix_dict, coords_dict):
+# Get the country of the cell of a position on the
+# countries grid (see country_grid.py)
+def getInfoFromGrid(lat_long, grid):
+    country_info = grid.getCell(lat_long[0], lat_long[1])
+    if country_info is None:
+        return ['', '']
+    return country_info
+
+def getCountryInfo(lat, long, matrix_grid):
 
     use_matrix = countries_config.use_matrix
     update_matrix = countries_config.update_matrix
@@ -146,34 +183,30 @@ def getCountryInfo(lat, long, matrix_dict, coords_dict):
             rep_file.close()
         if gen_err_file:
             err_file.close()
-        return [code, name, matrix_dict, coords_dict]
+        return [code, name, matrix_grid]
     elif lat_long in not_found_places_excludes:
             log_file.write("{} not skipped: [{}, {}] is at not found excludes\n".format(latlong, latitude, longitude))
 
     if use_matrix:
-        # get info from matrix dictionary
-        info = getInfoFromDictionary(lat_long, matrix_dict)
+        # get info from matrix grid
+        info = getInfoFromGrid(lat_long, matrix_grid)
         code = info[0]
         name = info[1]
         if code != '':
             if gen_rep_file and rep_matrix:
                 rep_file.write("Matrix: {} = [{}, {}] => '{}: {}'\n".format(latlong, latitude, longitude, code, name))
-            latlong_key = "{},{}".format(latitude, longitude)
-            if latlong_key not in small_countries_dict.keys():
-                matrix_dict[latlong_key] = [code, name]
 
     if code == '':
 
-        # get info from coordinates dictionary
-        info = getInfoFromDictionary(latlong, coords_dict)
+        # get info from the geocoded coordinates
+        info = getGeocodeStore().get(latlong)
         code = info[0]
         name = info[1]
 
         try:
             if name != countries_dict[code][0]:
                 name = countries_dict[code][0]
-                key = "{},{}".format(latlong[0], latlong[1])
-                coords_dict[key] = [code, name]
+                getGeocodeStore().put(latlong, [code, name])
         except:
             pass
 
@@ -187,7 +220,7 @@ def getCountryInfo(lat, long, matrix_dict, coords_dict):
             log_file.close()
             htm_file.close()
 
-            return [code, name, matrix_dict, coords_dict]
+            return [code, name, matrix_grid]
 
         # get info from Nominatim if not found in dictionary
         if code == '':
@@ -301,10 +334,9 @@ def getCountryInfo(lat, long, matrix_dict, coords_dict):
             if code != '' and code != '*':
                 rep_file.write("---> \'{}: {}\' = NOT FOUND AT DICTIONARY\n".format(code, name))
 
-        # add coordinate to dictionary
+        # add coordinate to the geocoded coordinates
         if code != '' and code != '*' and code != '**':
-            latlong_key = "{},{}".format(latlong[0], latlong[1])
-            coords_dict[latlong_key] = [code, name]
+            getGeocodeStore().put(latlong, [code, name])
 
         # location not found by any of the geocoders, decide if coordinates are added to not found list
         if code == '':
@@ -341,16 +373,15 @@ def getCountryInfo(lat, long, matrix_dict, coords_dict):
                     else:
                         htm_file.write("<a href=\"https://the-map-group.top/log/map/?lat={0}&long={1}\" target=\"_blank\">[{0}, {1}]</a> not added to not found list or excludes, an exception ocurred<br>\n".format(latitude, longitude))
                         log_file.write("[{}, {}] not added to not found list or excludes, an exception ocurred\n".format(latitude, longitude))
-                    not_found_file = open("{}/not_found.py".format(run_dir), "w")
-                    not_found_file.write("coords = [\n")
-                    for coord in not_found_places_list:
-                        not_found_file.write("  [{}, {}],\n".format(coord[0], coord[1]))
-                    not_found_file.write("]\n\n")
-                    not_found_file.write("excludes = [\n")
-                    for exclude in not_found_places_excludes:
-                        not_found_file.write("  [{}, {}],\n".format(exclude[0], exclude[1]))
-                    not_found_file.write("]\n")
-                    not_found_file.close()
+                    with AtomicFile("{}/not_found.py".format(run_dir)) as not_found_file:
+                        not_found_file.write("coords = [\n")
+                        for coord in not_found_places_list:
+                            not_found_file.write("  [{}, {}],\n".format(coord[0], coord[1]))
+                        not_found_file.write("]\n\n")
+                        not_found_file.write("excludes = [\n")
+                        for exclude in not_found_places_excludes:
+                            not_found_file.write("  [{}, {}],\n".format(exclude[0], exclude[1]))
+                        not_found_file.write("]\n")
                 except:
                     htm_file.write("<a href=\"https://the-map-group.top/log/map/?lat={0}&long={1}\" target=\"_blank\">[{0}, {1}]</a> not added to not found list or excludes, an exception ocurred<br>\n".format(latitude, longitude))
                     log_file.write("[{}, {}] not added to not found list or excludes, an exception ocurred\n".format(latitude, longitude))
@@ -408,7 +439,7 @@ def getCountryInfo(lat, long, matrix_dict, coords_dict):
                     if (code_01 == code or code_01 == '') and (code_10 == code or code_10 == '') and (code_11 == code or code_11 == ''):
                         latlong_key = "{},{}".format(latitude, longitude)
                         if latlong_key not in small_countries_dict.keys():
-                            matrix_dict[latlong_key] = [code, name]
+                            matrix_grid.setCell(latitude, longitude, [code, name])
                             if gen_rep_file:
                                 rep_file.write("-->+ {} = '{}: {}' added to matrix dictionary\n".format(lat_long, code, name))
                         elif gen_rep_file:
@@ -431,7 +462,7 @@ def getCountryInfo(lat, long, matrix_dict, coords_dict):
         if gen_err_file:
             err_file.close()
 
-    return [code, name, matrix_dict, coords_dict]
+    return [code, name, matrix_grid]
 
 
 # dictionaries
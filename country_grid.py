@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+
+# Dense grid with the country of each cell of one degree of the countries
+# matrix, replacing the 'lat,long' keyed dictionary of 'matrix.py'. Each
+# cell is the index (uint16) of its [code, name] on a small table of
+# countries, 0 for cells without a country. The cells are indexed by
+# the integer part of the coordinates, as the matrix keys, so there are
+# 181 latitudes (-90 to 90) by 361 longitudes (-180 to 180).
+#
+# The grid is saved in the binary file 'matrix.bin', that is memory
+# mapped when loaded, so there is nothing to parse at startup and a
+# lookup is an array index. Changes are kept in memory (copy on write)
+# until the grid is saved. The file has a header, the countries table
+# as json and the cells as little endian uint16:
+#
+#   'CGRD' | version, rows, columns, table size | table | cells
+#
+# The grid also works as the matrix dictionary ('lat,long' keys and
+# [code, name] values), and can be converted from and to it:
+#
+#   % python3 country_grid.py matrix.py matrix.bin
+#   % python3 country_grid.py matrix.bin matrix.py
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from atomic_file import AtomicFile
+
+
+# ================= CONFIGURATION VARIABLES =====================
+
+grid_file_name = 'matrix.bin'
+
+
+# ===============================================================
+
+file_magic = b'CGRD'
+file_version = 1
+header_format = '<HHHI'
+
+n_latitudes = 181
+n_longitudes = 361
+
+
+class CountryGrid:
+
+    # Load the grid from a file, or create an empty one if not given
+    def __init__(self, file_path=None):
+        self.file = None
+        self.mmap = None
+        self.view = None
+        # True if cells changed since the grid was loaded or saved
+        self.changed = False
+        if file_path is None:
+            self.countries = [['', '']]
+            self.cells = array('H', bytes(2 * n_latitudes * n_longitudes))
+        else:
+            self.open(file_path)
+        self.indexes = {tuple(country): i for i, country in enumerate(self.countries)}
+        self.size = sum(1 for cell in self.cells if cell != 0)
+
+    def open(self, file_path):
+        self.file = open(file_path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
+        header_size = len(file_magic) + struct.calcsize(header_format)
+        if self.mmap[:len(file_magic)] != file_magic:
+            self.close()
+            raise ValueError("'{}' is not a countries grid file".format(file_path))
+        version, rows, columns, table_size = struct.unpack_from(header_format, self.mmap, len(file_magic))
+        if version != file_version or rows != n_latitudes or columns != n_longitudes:
+            self.close()
+            raise ValueError("'{}' has an unsupported grid format".format(file_path))
+        self.countries = json.loads(self.mmap[header_size:header_size+table_size].decode())
+        offset = header_size + table_size + (header_size + table_size) % 2
+        cells = memoryview(self.mmap)[offset:offset + 2 * rows * columns]
+        if sys.byteorder == 'little':
+            self.view = cells
+            self.cells = cells.cast('H')
+        else:
+            self.cells = array('H', cells.tobytes())
+            self.cells.byteswap()
+            cells.release()
+
+    def close(self):
+        if self.view is not None:
+            # keep the cells in memory after the file is closed
+            cells = array('H', self.cells)
+            self.cells.release()
+            self.view.release()
+            self.view = None
+            self.cells = cells
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    # Save the grid, replacing the file at once
+    def save(self, file_path):
+        table = json.dumps(self.countries).encode()
+        header = file_magic + struct.pack(header_format, file_version, n_latitudes, n_longitudes, len(table))
+        cells = array('H', self.cells)
+        if sys.byteorder != 'little':
+            cells.byteswap()
+        # the mapped file is closed before it is replaced
+        reopen = self.mmap is not None and os.path.realpath(self.file.name) == os.path.realpath(file_path)
+        if reopen:
+            self.close()
+        with AtomicFile(file_path, 'wb') as grid_file:
+            grid_file.write(header + table + bytes((len(header) + len(table)) % 2) + cells.tobytes())
+        if reopen:
+            self.open(file_path)
+        self.changed = False
+
+    #===== CELLS ==============================================================#
+
+    def getIndex(self, latitude, longitude):
+        if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+            return (latitude + 90) * n_longitudes + longitude + 180
+        return None
+
+    # Get [code, name] of a cell, or None if it has no country
+    def getCell(self, latitude, longitude):
+        index = self.getIndex(latitude, longitude)
+        if index is None or self.cells[index] == 0:
+            return None
+        return list(self.countries[self.cells[index]])
+
+    def setCell(self, latitude, longitude, country_info):
+        index = self.getIndex(latitude, longitude)
+        if index is None:
+            raise KeyError("{},{}".format(latitude, longitude))
+        country = (country_info[0], country_info[1])
+        if country not in self.indexes:
+            if len(self.countries) > 0xFFFF:
+                raise ValueError("too many countries on the grid")
+            self.indexes[country] = len(self.countries)
+            self.countries.append(list(country))
+        if self.cells[index] == 0:
+            self.size += 1
+        if self.cells[index] != self.indexes[country]:
+            self.cells[index] = self.indexes[country]
+            self.changed = True
+
+    #===== DICTIONARY =========================================================#
+
+    def parseKey(self, key):
+        try:
+            latitude, longitude = key.split(',')
+            return [int(latitude), int(longitude)]
+        except (AttributeError, ValueError):
+            raise KeyError(key)
+
+    def __getitem__(self, key):
+        country_info = self.getCell(*self.parseKey(key))
+        if country_info is None:
+            raise KeyError(key)
+        return country_info
+
+    def __setitem__(self, key, country_info):
+        self.setCell(*self.parseKey(key), country_info)
+
+    def __contains__(self, key):
+        try:
+            return self.getCell(*self.parseKey(key)) is not None
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return self.size
+
+    # Keys of the cells with a country, from north to south and west to east
+    def __iter__(self):
+        for latitude in range(90, -91, -1):
+            row = (latitude + 90) * n_longitudes
+            for longitude in range(-180, 181):
+                if self.cells[row + longitude + 180] != 0:
+                    yield "{},{}".format(latitude, longitude)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [[key, self[key]] for key in self]
+
+    def toDictionary(self):
+        return {key: self[key] for key in self}
+
+
+def gridFromDictionary(matrix_dict):
+    grid = CountryGrid()
+    for key in matrix_dict:
+        grid[key] = matrix_dict[key]
+    return grid
+
+# Write a matrix dictionary as 'matrix.py'
+def writeMatrixFile(file_path, matrix_dict):
+    lines = ["  \'{}\': {}".format(key, matrix_dict[key]) for key in matrix_dict]
+    with AtomicFile(file_path) as matrix_file:
+        matrix_file.write("matrix_dict = {\n" + ",\n".join(lines) + ("\n" if len(lines) > 0 else "") + "}\n")
+
+# Load the grid of the run path, converting it from 'matrix.py'
+# when there is no grid file or the dictionary is newer
+def loadCountryGrid(run_path):
+    grid_path = "{}/{}".format(run_path, grid_file_name)
+    matrix_path = "{}/matrix.py".format(run_path)
+    if os.path.exists(grid_path):
+        if not os.path.exists(matrix_path) or os.path.getmtime(matrix_path) <= os.path.getmtime(grid_path):
+            return CountryGrid(grid_path)
+    from matrix import matrix_dict
+    grid = gridFromDictionary(matrix_dict)
+    grid.save(grid_path)
+    return grid
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 3:
+        print("Usage: {} <matrix.py|matrix.bin> <matrix.bin|matrix.py>".format(sys.argv[0]))
+        sys.exit()
+
+    source, target = sys.argv[1:]
+    if source.endswith('.py'):
+        sys.path.insert(0, os.path.dirname(os.path.realpath(source)))
+        matrix_dict = __import__(os.path.basename(source)[:-3]).matrix_dict
+        gridFromDictionary(matrix_dict).save(target)
+    else:
+        writeMatrixFile(target, CountryGrid(source))
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+# On-disk cache of Flickr API responses, so reruns after a crash, debug
+# runs and maps generated for the same account don't fetch the same pages
+# again. Each response is kept in its own file, named by a hash of the
+# method and the normalized parameters (signature, nonce and other
+# parameters that change on every request are left out of the key).
+#
+# Responses older than 'ttl' seconds are ignored. When the files take
+# more than 'max_size' bytes, the least recently used ones are removed.
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+# ================= CONFIGURATION VARIABLES =====================
+
+# Seconds a response is valid
+default_ttl = 6 * 3600
+
+# Maximum size of the cache directory in bytes
+default_max_size = 500 * 1024 * 1024
+
+# Parameters that are not part of the cache key
+ignored_params = ['api_key', 'format', 'nojsoncallback']
+
+
+# ===============================================================
+
+class FlickrCache:
+
+    def __init__(self, cache_dir, ttl=default_ttl, max_size=default_max_size):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    # Key of a request: the method plus its sorted parameters
+    def getKey(self, method, params):
+        normalized = sorted((key, str(value)) for key, value in params.items() if key not in ignored_params and not key.startswith('oauth_'))
+        return hashlib.sha1(json.dumps([method, normalized]).encode()).hexdigest()
+
+    def getPath(self, key):
+        return "{}/{}.json".format(self.cache_dir, key)
+
+    # Get a cached response, or None if there isn't a valid one
+    def get(self, method, params):
+        path = self.getPath(self.getKey(method, params))
+        try:
+            with open(path) as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, ValueError):
+            entry = None
+
+        if entry is None or time.time() - entry['time'] > self.ttl:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        # the modification time marks the last use of the entry
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return entry['data']
+
+    def put(self, method, params, data):
+        path = self.getPath(self.getKey(method, params))
+        temp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(temp_path, 'w') as cache_file:
+            json.dump({'time': time.time(), 'data': data}, cache_file)
+        os.replace(temp_path, path)
+        with self.lock:
+            if self.size is not None:
+                self.size += os.path.getsize(path)
+        self.evict()
+
+    # Remove the least recently used entries while the cache is too big
+    def evict(self):
+        with self.lock:
+            if self.size is not None and self.size <= self.max_size:
+                return
+            entries = []
+            for file_name in os.listdir(self.cache_dir):
+                if file_name.endswith('.json'):
+                    try:
+                        stat = os.stat("{}/{}".format(self.cache_dir, file_name))
+                        entries.append([stat.st_mtime, stat.st_size, file_name])
+                    except OSError:
+                        pass
+            self.size = sum(entry[1] for entry in entries)
+            entries.sort()
+            for mtime, size, file_name in entries:
+                if self.size <= self.max_size:
+                    break
+                try:
+                    os.remove("{}/{}".format(self.cache_dir, file_name))
+                    self.size -= size
+                    self.evictions += 1
+                except OSError:
+                    pass
+
+    def getReport(self):
+        requests = self.hits + self.misses
+        if requests == 0:
+            return []
+        return ["Cache: {} hit(s), {} miss(es) ({:.0f}% hits), {} eviction(s)".format(self.hits, self.misses, 100.0*self.hits/requests, self.evictions)]
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+# Asynchronous client for the Flickr API methods used to generate the map.
+# Requests are signed with the same OAuth token stored by the 'flickrapi'
+# package and all of them share a pool of keep-alive connections, so many
+# calls can be waited on at the same time from a single event loop.
+#
+# Usage:
+#
+#   client = AsyncFlickrClient(api_key, api_secret, flickr.token_cache.token)
+#   await client.open()
+#   photos = await client.getPhotos(user_id=user_id, page=1, per_page=500)
+#   await client.close()
+#
+# If a FlickrCache is given, responses are read from and saved to it,
+# unless the call is made with use_cache=False. A call can also give a
+# 'cache_tag', that is part of the cache key but is not sent to Flickr,
+# so a cached response is only used while the tag is the same.
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+import aiohttp
+import base64
+import hashlib
+import hmac
+import time
+import uuid
+import urllib.parse
+
+from rate_limiter import getLimiter
+
+
+# ================= CONFIGURATION VARIABLES =====================
+
+# Flickr REST endpoint
+rest_url = 'https://api.flickr.com/services/rest/'
+
+# Connections pool
+max_connections = 8
+keepalive_timeout = 60
+
+# Seconds to wait for a response
+request_timeout = 60
+
+# Flickr API error codes of temporary failures, worth trying again
+# (105 = service currently unavailable)
+retryable_codes = [105]
+
+
+# ===============================================================
+
+# Error returned by the Flickr API ('code') or by the HTTP layer ('status'),
+# transport errors have neither
+class FlickrError(Exception):
+
+    def __init__(self, message, code=None, retry_after=None, status=None):
+        Exception.__init__(self, message)
+        self.code = code
+        self.retry_after = retry_after
+        self.status = status
+
+
+# Errors that may be solved by trying again: transport errors, HTTP 429
+# and 5xx and temporary API errors. Other API errors (user not found,
+# invalid api key, ...) fail the same way on every try
+def isFlickrErrorRetryable(error):
+    if not isinstance(error, FlickrError):
+        return True
+    if error.status is not None:
+        return error.status == 429 or error.status >= 500
+    if error.code is not None:
+        return str(error.code) in [str(code) for code in retryable_codes]
+    return True
+
+
+class AsyncFlickrClient:
+
+    def __init__(self, api_key, api_secret, token=None, max_connections=max_connections, cache=None):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.token = token
+        self.max_connections = max_connections
+        self.cache = cache
+        self.session = None
+
+    # Create the shared connections pool, must be
+    # called from inside the running event loop
+    async def open(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=keepalive_timeout)
+            timeout = aiohttp.ClientTimeout(total=request_timeout)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    # Add the OAuth 1.0a (HMAC-SHA1) parameters to a request,
+    # the same signature 'flickrapi' uses for authenticated calls
+    def signParams(self, params):
+        if self.token is None:
+            return params
+
+        params = dict(params)
+        params['oauth_consumer_key'] = self.api_key
+        params['oauth_nonce'] = uuid.uuid4().hex
+        params['oauth_timestamp'] = str(int(time.time()))
+        params['oauth_signature_method'] = 'HMAC-SHA1'
+        params['oauth_version'] = '1.0'
+        params['oauth_token'] = self.token.token
+
+        quote = lambda value: urllib.parse.quote(str(value), safe='~')
+        normalized = '&'.join('{}={}'.format(quote(key), quote(params[key])) for key in sorted(params))
+        base_string = '&'.join(['GET', quote(rest_url), quote(normalized)])
+        signing_key = '{}&{}'.format(quote(self.api_secret), quote(self.token.token_secret))
+        digest = hmac.new(signing_key.encode(), base_string.encode(), hashlib.sha1).digest()
+        params['oauth_signature'] = base64.b64encode(digest).decode()
+
+        return params
+
+    # Call a Flickr API method and return the parsed json response
+    async def call(self, method, use_cache=True, cache_tag=None, **params):
+        await self.open()
+
+        params = {key: str(value) for key, value in params.items() if value is not None}
+        params['method'] = method
+        params['api_key'] = self.api_key
+        params['format'] = 'json'
+        params['nojsoncallback'] = '1'
+
+        use_cache = use_cache and self.cache is not None
+        cache_params = params
+        if cache_tag is not None:
+            cache_params = dict(params, cache_tag=cache_tag)
+        if use_cache:
+            data = self.cache.get(method, cache_params)
+            if data is not None:
+                return data
+
+        await getLimiter('flickr').acquireAsync()
+
+        try:
+            async with self.session.get(rest_url, params=self.signParams(params)) as response:
+                if response.status != 200:
+                    raise FlickrError('HTTP {} calling {}'.format(response.status, method), retry_after=response.headers.get('Retry-After'), status=response.status)
+                data = await response.json(content_type=None)
+        except aiohttp.ClientError as e:
+            raise FlickrError('{} calling {}'.format(str(e), method))
+
+        if data.get('stat') != 'ok':
+            raise FlickrError('Error: {}: {}'.format(data.get('code'), data.get('message')), data.get('code'))
+
+        if use_cache:
+            self.cache.put(method, cache_params, data)
+
+        return data
+
+    async def lookupUser(self, url):
+        return await self.call('flickr.urls.lookupUser', url=url)
+
+    async def getInfo(self, user_id):
+        return await self.call('flickr.people.getInfo', user_id=user_id)
+
+    async def getPublicPhotos(self, user_id, **params):
+        return await self.call('flickr.people.getPublicPhotos', user_id=user_id, **params)
+
+    async def getPhotos(self, user_id, **params):
+        return await self.call('flickr.people.getPhotos', user_id=user_id, **params)
+
+    async def searchPhotos(self, user_id, **params):
+        return await self.call('flickr.photos.search', user_id=user_id, **params)
+
+    async def getPhotosetPhotos(self, photoset_id, user_id, **params):
+        return await self.call('flickr.photosets.getPhotos', photoset_id=photoset_id, user_id=user_id, **params)
+
+    async def getRecentlyUpdated(self, min_date, **params):
+        return await self.call('flickr.photos.recentlyUpdated', min_date=min_date, **params)
@@ -8,17 +8,29 @@
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 import flickrapi
+import asyncio
 import json
 import os
 import sys
 import time
 import math
-import random
+import copy
 
-from matrix import matrix_dict
-from coords import coords_dict
-from countries_info import getCountryInfo
+from countries_info import getCountryInfo, closeGeocodeStore
 from countries_config import update_matrix
+from flickr_client import AsyncFlickrClient, isFlickrErrorRetryable
+from rate_limiter import getReport
+from retry_policy import RetryPolicy
+from checkpoint import Checkpoint
+from flickr_cache import FlickrCache
+from marker_clusters import ClusterIndex
+from marker_store import MarkerStore
+from map_stats import MapStats
+from map_db import MapDatabase
+from country_grid import loadCountryGrid, writeMatrixFile, grid_file_name
+from atomic_file import AtomicFile, writeFileIfChanged
+from geojson_export import writeLocationsGeoJson, geojson_file_name
+from map_pipeline import getMarkerKeyFunction, getSpreadKey, isMappable, pageSource, filterPhotos, aggregateMarkers, buildMarkersIndex, mergeMarkers
 
 
 # ================= CONFIGURATION VARIABLES =====================
@@ -28,6 +40,60 @@ photos_per_page = '500'
 max_number_of_pages = 200
 max_number_of_photos = max_number_of_pages * int(photos_per_page)
 
+# Concurrency
+# number of pages fetched at the same time
+max_page_workers = 4
+# number of connections kept alive on the pool
+max_connections = 8
+
+# Geotagged photos
+# use flickr.photos.search with 'has_geo' so only the photos that
+# can be mapped are transferred, instead of paging all of them
+search_geotagged_only = True
+# flickr.photos.search returns at most this number of photos of a query
+search_max_results = 4000
+
+# Partitioning
+# split big photostreams in upload date windows small enough to be
+# paged cheaply, fetching all the photos instead of only the last
+# 'max_number_of_photos' ones
+partition_by_date = False
+max_photos_per_window = 4000
+
+# Markers merging
+# photos are merged in the same marker when:
+# '' = they have the exact same coordinates
+# 'decimals' = coordinates are the same rounded to 'snap_precision' decimal places
+# 'geohash' = they are in the same geohash cell of 'snap_precision' characters
+# 'distance' = they are up to 'snap_distance' meters from the marker
+snap_mode = ''
+snap_precision = 4
+snap_distance = 25
+# position of a merged marker:
+# 'first' = the first photo's position, 'centroid' = the centroid of its photos
+snap_position = 'first'
+
+# Clusters
+# generate the clusters of markers shown on map at low zooms
+generate_clusters = True
+cluster_radius = 60     # pixels
+cluster_max_zoom = 14   # markers are shown after this zoom
+
+# GeoJSON
+# also export the markers to 'locations.geojson', that the map loads
+# off the main thread when it's served over http
+export_geojson = True
+
+# Debug
+# compare the markers and photos counters with a full count at the end
+check_counters = False
+
+# Cache of the Flickr API responses
+# can also be bypassed with '--no-cache' in the command line
+use_cache = True
+cache_ttl = 6 * 3600                # seconds
+cache_max_size = 500 * 1024 * 1024  # bytes
+
 
 # ===============================================================
 
@@ -69,52 +135,203 @@ else:
 api_key = api_credentials.api_key
 api_secret = api_credentials.api_secret
 
-# Flickr api access
+# Flickr api access, the 'flickrapi' package is used only to get the
+# OAuth token, all calls are made by the asynchronous client through
+# a single event loop that runs the whole fetch phase
 flickr = flickrapi.FlickrAPI(api_key, api_secret, format='parsed-json')
 
+# responses of the photos pages and user info are cached on disk,
+# the queries that detect changes always go to Flickr
+if use_cache and '--no-cache' not in sys.argv:
+    flickr_cache = FlickrCache("{}/cache".format(run_path), cache_ttl, cache_max_size)
+else:
+    flickr_cache = None
+
+flickr_async = AsyncFlickrClient(api_key, api_secret, flickr.token_cache.token, max_connections, flickr_cache)
+
+# photostream query, when filtered by Flickr only the geotagged photos are
+# returned, in the same order (newest first) of people.getPhotos
+if search_geotagged_only:
+    photostream_method = flickr_async.searchPhotos
+    photostream_filter = {'has_geo': 1, 'sort': 'date-posted-desc'}
+    # photos.search returns only the first 'search_max_results' photos
+    # of a query, bigger photostreams are split in date windows
+    max_photos_per_window = min(max_photos_per_window, search_max_results)
+else:
+    photostream_method = flickr_async.getPhotos
+    photostream_filter = dict()
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+
 
 #===== FUNCTIONS ==============================================================#
 
-# Function to get photo's geo privacy
-def getGeoPrivacy(photo):
-    if photo['geo_is_public'] == 1:
-        return 1
-    if photo['geo_is_contact'] == 1:
-        return 2
-    if photo['geo_is_friend'] == 1 and photo['geo_is_family'] == 0:
-        return 3
-    if photo['geo_is_friend'] == 0 and photo['geo_is_family'] == 1:
-        return 4
-    if photo['geo_is_friend'] == 1 and photo['geo_is_family'] == 1:
-        return 5
-    if photo['geo_is_friend'] == 0 and photo['geo_is_family'] == 0:
-        return 6
-
-# Function to verify if there is geo tag info
-def isGeoTagged(photo):
-    if photo['latitude'] == 0 and photo['longitude'] == 0 and photo['accuracy'] == 0:
-        return False
-    return True
-
-# Get the number of markers on locations dictionary
-def getNumberOfMarkers(dict):
-    n = 0
-    for key in dict:
-        n += len(dict[key])
-    return n
-
-# Get the number of photos on locations dictionary
-def getNumberOfPhotos(dict):
-    p = 0
-    for key in dict:
-        for marker in dict[key]:
-            p += len(marker[1])
-    return p
+# Report a failed try to get photos before trying again
+def logPhotosRetry(tries, error, delay):
+    print("ERROR: Unable to get photos")
+    print(str(error))
+    print('Trying again in {:.1f}s...'.format(delay))
+    log_file.write("ERROR: Unable to get photos\n")
+    log_file.write('{}\n'.format(str(error)))
+    log_file.write('Trying again in {:.1f}s...\n'.format(delay))
+
+# Get a page of photos according to run mode, trying again
+# with backoff up to 'max_tries' times before giving up.
+# 'sync_query' limits the photostream to the photos uploaded
+# up to the newest one (and since the last run, on incremental
+# runs), cached pages are used only with the same 'pages_tag'
+async def getPhotosPage(pg):
+    if mode == 'photoset':
+        photos = await flickr_retry.callAsync('flickr', flickr_async.getPhotosetPhotos, config.photoset_id, user_id, privacy_filter=config.photo_privacy, content_types=0, extras=photos_extras, page=pg, per_page=photos_per_page, cache_tag=pages_tag)
+        return photos['photoset']['photo']
+    else:
+        photos = await flickr_retry.callAsync('flickr', photostream_method, user_id, privacy_filter=config.photo_privacy, content_types=0, extras=photos_extras, page=pg, per_page=photos_per_page, cache_tag=pages_tag, **sync_query, **photostream_filter)
+        return photos['photos']['photo']
+
+# Split the upload dates from 'min_date' to 'max_date' in windows with
+# up to 'max_photos_per_window' photos, counting the photos of the windows
+# concurrently. Returns [min_date, max_date, number of photos] for each
+# window, from the newest to the oldest one
+async def getDateWindows(min_date, max_date):
+    semaphore = asyncio.Semaphore(max_page_workers)
+
+    async def countPhotos(min_date, max_date):
+        async with semaphore:
+            photos = await flickr_retry.callAsync('flickr', photostream_method, user_id, privacy_filter=config.photo_privacy, content_types=0, min_upload_date=min_date, max_upload_date=max_date, per_page=1, use_cache=False, **photostream_filter)
+        return int(photos['photos']['total'])
+
+    async def splitWindow(min_date, max_date, count):
+        if count <= max_photos_per_window or max_date <= min_date:
+            return [[min_date, max_date, count]]
+        middle_date = (min_date + max_date) // 2
+        older, newer = await asyncio.gather(countPhotos(min_date, middle_date), countPhotos(middle_date+1, max_date))
+        windows = await asyncio.gather(splitWindow(middle_date+1, max_date, newer), splitWindow(min_date, middle_date, older))
+        return windows[0] + windows[1]
+
+    windows = await splitWindow(min_date, max_date, await countPhotos(min_date, max_date))
+    return [window for window in windows if window[2] > 0]
+
+# Get a page of a date window, 'pg' is the index on 'window_pages'
+# of the [min_date, max_date, page, number of photos] to be fetched,
+# cached pages are used only while the window has the same photos
+async def getWindowPage(pg):
+    min_date, max_date, window_page, window_photos = window_pages[pg-1]
+    photos = await flickr_retry.callAsync('flickr', photostream_method, user_id, privacy_filter=config.photo_privacy, content_types=0, extras=photos_extras, min_upload_date=min_date, max_upload_date=max_date, page=window_page, per_page=photos_per_page, cache_tag=window_photos, **photostream_filter)
+    return photos['photos']['photo']
+
+# Get all the photos of the user updated since 'min_date'
+async def getUpdatedPhotos(min_date):
+    updated = []
+    pg = 1
+    pages = 1
+    while pg <= pages:
+        photos = await flickr_retry.callAsync('flickr', flickr_async.getRecentlyUpdated, min_date, extras=photos_extras, page=pg, per_page=photos_per_page, use_cache=False)
+        pages = int(photos['photos']['pages'])
+        updated += photos['photos']['photo']
+        pg += 1
+    return updated
+
+# Get all photos returned by 'method', the pages are requested
+# without extras (unless given) so listing all of them is cheap
+async def getPhotoList(method, result_key, *args, **params):
+    photos = await flickr_retry.callAsync('flickr', method, *args, page=1, per_page=photos_per_page, **params)
+    npages = int(photos[result_key]['pages'])
+    photo_list = photos[result_key]['photo']
+
+    semaphore = asyncio.Semaphore(max_page_workers)
+    async def getListPage(pg):
+        async with semaphore:
+            photos = await flickr_retry.callAsync('flickr', method, *args, page=pg, per_page=photos_per_page, **params)
+        return photos[result_key]['photo']
+
+    for page_photos in await asyncio.gather(*[getListPage(pg) for pg in range(2, npages+1)]):
+        photo_list += page_photos
+
+    return photo_list
+
+# Get all photos on the photostream, always listed with people.getPhotos,
+# as photos.search stops at 'search_max_results'
+async def getPhotostreamList(extras=None):
+    return await getPhotoList(flickr_async.getPhotos, 'photos', user_id, privacy_filter=config.photo_privacy, content_types=0, extras=extras, use_cache=False)
+
+# Remove photos from the markers on map, deleting the markers left empty
+# and updating the countries numbers of markers and photos in place.
+# Returns the number of photos and markers removed
+def removePhotosFromMap(locations_dict, countries_dict, photo_ids):
+    removed_photos = 0
+    removed_markers = 0
+    for country_code in list(locations_dict):
+        country_markers = []
+        for marker in locations_dict[country_code]:
+            photos_info = [photo for photo in marker[1] if photo[0] not in photo_ids]
+            removed_photos += len(marker[1]) - len(photos_info)
+            if len(photos_info) > 0:
+                if len(photos_info) < len(marker[1]):
+                    map_stats.addPhotos(country_code, len(photos_info) - len(marker[1]))
+                    if cluster_index is not None:
+                        cluster_index.addPhotos(marker[0], len(photos_info) - len(marker[1]))
+                    map_db.removePhotos([photo[0] for photo in marker[1] if photo[0] in photo_ids])
+                    marker[1] = photos_info
+                country_markers.append(marker)
+            else:
+                map_stats.removeMarker(country_code, len(marker[1]))
+                if cluster_index is not None:
+                    cluster_index.removeMarker(marker[0], len(marker[1]))
+                if snap_mode == 'distance':
+                    marker_key.remove(marker[0][0], marker[0][1])
+                map_db.removeMarker(marker.id)
+                removed_markers += 1
+        if len(country_markers) > 0:
+            locations_dict[country_code] = country_markers
+            if country_code in countries_dict:
+                countries_dict[country_code][1:] = map_stats.getCountry(country_code)
+        else:
+            del locations_dict[country_code]
+            if country_code in countries_dict:
+                del countries_dict[country_code]
+    return [removed_photos, removed_markers]
+
+# Remove the photos deleted from the photostream from the map, they are
+# found by diffing the ids on map against an ids only listing (or with
+# 'extras', if given). Returns the photos listed
+def removeDeletedPhotos(n_deleted, extras=None):
+    print('{} photo(s) deleted from photostream.\nThe corresponding markers will also be deleted'.format(n_deleted))
+    log_file.write('{} photo(s) deleted from photostream.\nThe corresponding markers will also be deleted\n'.format(n_deleted))
+
+    try:
+        photostream_photos = loop.run_until_complete(getPhotostreamList(extras))
+    except Exception as e:
+        print("ERROR: FATAL: Unable to get photos after {} tries".format(getattr(e, 'tries', max_tries)))
+        print(str(e))
+        log_file.write("ERROR: FATAL: Unable to get photos after {} tries\n".format(getattr(e, 'tries', max_tries)))
+        log_file.write('{}\n'.format(str(e)))
+        os.system("touch {}/fatal".format(run_path))
+        sys.exit()
+
+    photostream_ids = set(photo['id'] for photo in photostream_photos)
+    deleted_ids = set()
+    for country_code in locations_dict:
+        for marker in locations_dict[country_code]:
+            for photo in marker[1]:
+                if photo[0] not in photostream_ids:
+                    deleted_ids.add(photo[0])
+
+    removed = removePhotosFromMap(locations_dict, countries_dict, deleted_ids)
+    print('Removed {} photo(s) and {} empty marker(s) from map'.format(removed[0], removed[1]))
+    log_file.write('Removed {} photo(s) and {} empty marker(s) from map\n'.format(removed[0], removed[1]))
+
+    return photostream_photos
+
+# Update last_sync file with the upload and update dates high-water
+# marks and the number of photos on the photostream
+def updateLastSyncFile(run_path, upload_date, update_date, sync_total):
+    if os.path.exists("{}/locations.py".format(run_path)):
+        writeFileIfChanged("{}/last_sync.py".format(run_path), "upload_date = {}\nupdate_date = {}\ntotal = {}\n".format(upload_date, update_date, sync_total))
 
 # Update last_total file with the new value
 def updateLastTotalFile(run_path, current_total):
     if os.path.exists("{}/locations.py".format(run_path)):
-        os.system("echo \"number = {0}\" > {1}/last_total.py".format(current_total, run_path))
+        writeFileIfChanged("{}/last_total.py".format(run_path), "number = {}\n".format(current_total))
 
 
 #===== MAIN CODE ==============================================================#
@@ -123,7 +340,7 @@ user_alias = config.user
 
 # get user id from user url on config file
 try:
-    user_id = flickr.urls.lookupUser(api_key=api_key, url='flickr.com/people/{}'.format(user_alias))['user']['id']
+    user_id = loop.run_until_complete(flickr_async.lookupUser('flickr.com/people/{}'.format(user_alias)))['user']['id']
 except Exception as e:
     print("ERROR: FATAL: Unable to get user id")
     print(str(e))
@@ -134,7 +351,7 @@ except Exception as e:
 
 # get user info
 try:
-    user_info = flickr.people.getInfo(api_key=api_key, user_id=user_id)
+    user_info = loop.run_until_complete(flickr_async.getInfo(user_id))
 except Exception as e:
     print("ERROR: FATAL: Unable to get user info")
     print(str(e))
@@ -189,8 +406,16 @@ try:
 except:
     user_location = ""
 
+# key of the marker each photo belongs to
+marker_key = getMarkerKeyFunction(snap_mode, snap_precision, snap_distance)
+centroid = snap_position == 'centroid'
+
+# columnar store of the markers, on map and new ones
+marker_store = MarkerStore()
+
 # stores the coordinates fo the markers
-coords = []
+# indexed by marker key, in the order they were found
+coords = dict()
 
 # set script mode (photoset or photostream)
 if config.photoset_id != '':
@@ -198,56 +423,208 @@ if config.photoset_id != '':
 else:
     mode = 'photostream'
 
-# get the total number of photos
+# extra information requested for each photo
+photos_extras = 'geo,tags,url_sq,date_upload,last_update'
+
+# get the total number of photos, the same retry policy
+# (and 'flickr' circuit breaker) is used for all the pages,
+# errors of the API that are not temporary are not retried
 max_tries = 10
+flickr_retry = RetryPolicy(max_tries=max_tries, retryable=isFlickrErrorRetryable, on_retry=logPhotosRetry)
 
-for tries in range(1, max_tries+1):
-    try:
-        if mode == 'photoset':
-            photos = flickr.photosets.getPhotos(api_key=api_key, user_id=user_id, photoset_id=config.photoset_id, privacy_filter=config.photo_privacy, content_types=0, per_page=photos_per_page)
-            npages = int(photos['photoset']['pages'])
-            total = int(photos['photoset']['total'])
-            print('Generating map for \'{}\''.format(user_name))
-            print('Photoset \'{}\''.format(photos['photoset']['title']))
-            print('{} photos in the photoset'.format(total))
-            log_file.write('Generating map for \'{}\'\n'.format(user_name))
-            log_file.write('Photoset \'{}\'\n'.format(photos['photoset']['title']))
-            log_file.write('{} photos in the photoset\n'.format(total))
-        else:
-            photos = flickr.people.getPublicPhotos(api_key=api_key, user_id=user_id, content_types=0, per_page=photos_per_page)
-            npages = int(photos['photos']['pages'])
-            total = int(photos['photos']['total'])
-            print('Generating map for \'{}\''.format(user_name))
-            print('{} photos in the photostream'.format(total))
-            log_file.write('Generating map for \'{}\'\n'.format(user_name))
-            log_file.write('{} photos in the photostream\n'.format(total))
-        break
-    except Exception as e:
-        if tries < max_tries:
-            print("ERROR: Unable to get photos")
-            print(str(e))
-            print('Trying again...')
-            log_file.write("ERROR: Unable to get photos\n")
-            log_file.write('{}\n'.format(str(e)))
-            log_file.write('Trying again...\n')
-        else:
-            print("ERROR: FATAL: Unable to get photos after {}".format(max_tries))
-            print(str(e))
-            log_file.write("ERROR: FATAL: Unable to get photos after {} tries\n".format(max_tries))
-            log_file.write('{}\n'.format(str(e)))
-            os.system("touch {}/fatal".format(run_path))
-            sys.exit()
+# upload date of the newest photo on the photostream
+newest_upload_date = 0
+
+try:
+    if mode == 'photoset':
+        photos = loop.run_until_complete(flickr_retry.callAsync('flickr', flickr_async.getPhotosetPhotos, config.photoset_id, user_id, privacy_filter=config.photo_privacy, content_types=0, per_page=photos_per_page, use_cache=False))
+        npages = int(photos['photoset']['pages'])
+        total = int(photos['photoset']['total'])
+        print('Generating map for \'{}\''.format(user_name))
+        print('Photoset \'{}\''.format(photos['photoset']['title']))
+        print('{} photos in the photoset'.format(total))
+        log_file.write('Generating map for \'{}\'\n'.format(user_name))
+        log_file.write('Photoset \'{}\'\n'.format(photos['photoset']['title']))
+        log_file.write('{} photos in the photoset\n'.format(total))
+    else:
+        photos = loop.run_until_complete(flickr_retry.callAsync('flickr', flickr_async.getPublicPhotos, user_id, content_types=0, per_page=photos_per_page, use_cache=False))
+        npages = int(photos['photos']['pages'])
+        total = int(photos['photos']['total'])
+        print('Generating map for \'{}\''.format(user_name))
+        print('{} photos in the photostream'.format(total))
+        log_file.write('Generating map for \'{}\'\n'.format(user_name))
+        log_file.write('{} photos in the photostream\n'.format(total))
+        # number of photos on the photostream under the privacy filter,
+        # used to detect deleted photos on incremental runs
+        photos = loop.run_until_complete(flickr_retry.callAsync('flickr', flickr_async.getPhotos, user_id, privacy_filter=config.photo_privacy, content_types=0, extras='date_upload', per_page=1, use_cache=False))
+        sync_total = int(photos['photos']['total'])
+        # upload date of the newest photo, where the date windows end, so
+        # they (and the checkpoint cursor) are the same when a run resumes
+        if len(photos['photos']['photo']) > 0:
+            newest_upload_date = int(photos['photos']['photo'][0]['dateupload'])
+except Exception as e:
+    print("ERROR: FATAL: Unable to get photos after {} tries".format(getattr(e, 'tries', max_tries)))
+    print(str(e))
+    log_file.write("ERROR: FATAL: Unable to get photos after {} tries\n".format(getattr(e, 'tries', max_tries)))
+    log_file.write('{}\n'.format(str(e)))
+    os.system("touch {}/fatal".format(run_path))
+    sys.exit()
 
 # current number of photos on photostream
 current_total = total
 
+# database with the state of the map, on the first run the state
+# is migrated from the files written by the previous versions
+map_db = MapDatabase(run_path)
+
+if not map_db.created:
+    locations_dict = map_db.loadLocations(marker_store)
+    countries_dict = map_db.loadCountries()
+else:
+    # check if there is a file with the markers on map already
+    # and import it otherwise created a new variable
+    if os.path.exists("{}/locations.py".format(run_path)):
+        from locations import locations_dict
+        # keep the markers on the store, dropping the imported lists
+        locations_dict = marker_store.addLocations(locations_dict)
+        del sys.modules['locations']
+    else:
+        locations_dict = dict()
+    map_db.addLocations(locations_dict)
+
+    # check if there is file with the countries already mapped
+    if os.path.exists("{}/countries.py".format(run_path)):
+        from countries import countries_dict
+    else:
+        countries_dict = dict()
+    map_db.saveCountries(countries_dict)
+
+    if os.path.exists("{}/last_sync.py".format(run_path)):
+        import last_sync
+        map_db.setSync('upload_date', last_sync.upload_date)
+        map_db.setSync('update_date', last_sync.update_date)
+        map_db.setSync('total', last_sync.total)
+
+    if os.path.exists("{}/last_total.py".format(run_path)):
+        import last_total
+        map_db.setSync('last_total', last_total.number)
+
+    map_db.finishMigration()
+
+# countries as loaded, to know if they changed on the run
+loaded_countries = copy.deepcopy(countries_dict)
+
+# country of each cell of the countries matrix, memory mapped from
+# the grid file (converted from 'matrix.py' when it is newer)
+matrix_grid = loadCountryGrid(run_path)
+
+# when merging by distance, index the markers on map so
+# the new photos near them are merged into them
+if snap_mode == 'distance':
+    marker_key.load(locations_dict)
+
+# counters of the markers and photos on map, updated as they change
+map_stats = MapStats()
+map_stats.build(locations_dict)
+
+# load the clusters of markers of the previous run, they are updated as
+# markers and photos are added or removed, instead of being rebuilt
+cluster_index = None
+
+if generate_clusters:
+    cluster_index = ClusterIndex(cluster_radius, cluster_max_zoom)
+    clusters_loaded = False
+    if os.path.exists("{}/clusters.py".format(run_path)):
+        try:
+            from clusters import clusters_info, clusters_dict
+            clusters_loaded = cluster_index.load(clusters_info, clusters_dict, map_stats.n_markers, map_stats.n_photos)
+        except Exception as e:
+            print("ERROR: Unable to load clusters, they will be rebuilt")
+            print(str(e))
+            log_file.write("ERROR: Unable to load clusters, they will be rebuilt\n")
+            log_file.write('{}\n'.format(str(e)))
+            cluster_index = ClusterIndex(cluster_radius, cluster_max_zoom)
+    if not clusters_loaded:
+        cluster_index.build(locations_dict)
+
 # difference on number of photos from previous run
 delta_total = int(total)
 
+# upload and update dates high-water marks, extra query parameters for
+# the photostream pages and photos updated since the last run
+sync_upload_date = 0
+sync_update_date = 0
+sync_query = dict()
+updated_photos = []
+
+# if the photostream was synced before, process only the photos uploaded
+# or updated after the last run instead of comparing the number of photos
+incremental = mode == 'photostream' and map_db.getSync('total') is not None
+
+if incremental:
+    sync_upload_date = map_db.getSync('upload_date')
+    sync_update_date = map_db.getSync('update_date')
+
+    try:
+        photos = loop.run_until_complete(flickr_retry.callAsync('flickr', flickr_async.getPhotos, user_id, privacy_filter=config.photo_privacy, content_types=0, min_upload_date=sync_upload_date+1, per_page=1, use_cache=False))
+        n_new = int(photos['photos']['total'])
+        # updates can only be listed on the authenticated user's own photos
+        if flickr_async.token is not None and flickr_async.token.user_nsid == user_id:
+            updated_photos = loop.run_until_complete(getUpdatedPhotos(sync_update_date+1))
+    except Exception as e:
+        print("ERROR: FATAL: Unable to get photos after {} tries".format(getattr(e, 'tries', max_tries)))
+        print(str(e))
+        log_file.write("ERROR: FATAL: Unable to get photos after {} tries\n".format(getattr(e, 'tries', max_tries)))
+        log_file.write('{}\n'.format(str(e)))
+        os.system("touch {}/fatal".format(run_path))
+        sys.exit()
+
+    # photos missing from the photostream were deleted
+    n_deleted = map_db.getSync('total') + n_new - sync_total
+
+    if n_new == 0 and n_deleted <= 0 and len(updated_photos) == 0:
+        print('No changes on photostream since last run.\nAborted.')
+        log_file.write('No changes on photostream since last run.\nAborted.\n')
+        sys.exit()
+
+    if n_deleted > 0:
+        removeDeletedPhotos(n_deleted)
+
+    total = n_new
+    sync_query = {'min_upload_date': sync_upload_date+1}
+    print('{} new photo(s) added'.format(n_new))
+    log_file.write('{} new photo(s) added\n'.format(n_new))
+
+    if len(updated_photos) > 0:
+        print('{} photo(s) updated'.format(len(updated_photos)))
+        log_file.write('{} photo(s) updated\n'.format(len(updated_photos)))
+
+        # take out of the map the updated photos that were moved or
+        # can't be mapped anymore, the others stay on their markers
+        # the positions are only compared, when merging by distance
+        # they are not added to the index of markers
+        lookup_key = marker_key.lookup if snap_mode == 'distance' else marker_key
+
+        markers_keys = dict()
+        for country_code in locations_dict:
+            for marker in locations_dict[country_code]:
+                for photo in marker[1]:
+                    markers_keys[photo[0]] = lookup_key(marker[0][0], marker[0][1])
+
+        moved_ids = set()
+        for photo in updated_photos:
+            if photo['id'] in markers_keys:
+                if not isMappable(photo, config.geo_privacy, config.dont_map_tag) or markers_keys[photo['id']] != lookup_key(float(photo['longitude']), float(photo['latitude'])):
+                    moved_ids.add(photo['id'])
+
+        if len(moved_ids) > 0:
+            removed = removePhotosFromMap(locations_dict, countries_dict, moved_ids)
+            print('Removed {} moved or hidden photo(s) and {} empty marker(s) from map'.format(removed[0], removed[1]))
+            log_file.write('Removed {} moved or hidden photo(s) and {} empty marker(s) from map\n'.format(removed[0], removed[1]))
+
 # if there is no difference, finish script
-if os.path.exists("{}/last_total.py".format(run_path)):
-    import last_total
-    delta_total = int(current_total) - int(last_total.number)
+elif map_db.getSync('last_total') is not None:
+    delta_total = int(current_total) - map_db.getSync('last_total')
     if delta_total == 0:
         print('No changes on number of photos since last run.\nAborted.')
         log_file.write('No changes on number of photos since last run.\nAborted.\n')
@@ -255,25 +632,64 @@ if os.path.exists("{}/last_total.py".format(run_path)):
 
 # if difference > 0, makes total = delta_total
 # to process only the new photos, otherwise
-# (photos were deleted), run in all
-# photostream to update the entire map
-if mode == 'photostream':
+# (photos were deleted), remove them from the
+# map, there are no new photos to process
+if mode == 'photostream' and not incremental:
     if delta_total > 0:
         if total != delta_total:
             total = delta_total
             print('{} new photo(s) added'.format(total))
             log_file.write('{} new photo(s) added\n'.format(total))
-    else:
-        n_deleted = abs(delta_total)
-        if os.path.exists("{}/locations.py".format(run_path)):
-            os.system("rm {}/locations.py".format(run_path))
-        if os.path.exists("{}/countries.py".format(run_path)):
-            os.system("rm {}/countries.py".format(run_path))
-        if os.path.exists("{}/user.py".format(run_path)):
-            os.system("rm {}/user.py".format(run_path))
-        print('{} photo(s) deleted from photostream.\nThe corresponding markers will also be deleted'.format(n_deleted))
-        log_file.write('{} photo(s) deleted from photostream.\nThe corresponding markers will alse be deleted\n'.format(n_deleted))
+    elif len(locations_dict) > 0:
+        # photos may also have been uploaded, so the photostream is
+        # listed with the photos information: the ones that can be
+        # mapped and are not on the map yet are added from the listing
+        # (as the updated photos), it is not paged again
+        photostream_photos = removeDeletedPhotos(abs(delta_total), photos_extras)
+        map_ids = set(photo[0] for country_code in locations_dict for marker in locations_dict[country_code] for photo in marker[1])
+        for photo in photostream_photos:
+            sync_upload_date = max(sync_upload_date, int(photo['dateupload']))
+            sync_update_date = max(sync_update_date, int(photo['lastupdate']))
+            if photo['id'] not in map_ids and isMappable(photo, config.geo_privacy, config.dont_map_tag):
+                updated_photos.append(photo)
+        del photostream_photos
+        total = 0
+        print('{} photo(s) not on the map yet'.format(len(updated_photos)))
+        log_file.write('{} photo(s) not on the map yet\n'.format(len(updated_photos)))
+
+# the photostream pages are limited to the photos uploaded up to the
+# newest one counted, so the photos uploaded while they are fetched
+# (or while they are cached) don't shift them
+if mode == 'photostream' and newest_upload_date > 0:
+    sync_query['max_upload_date'] = newest_upload_date
+
+# number of geotagged photos, when filtered by Flickr
+geo_total = None
+
+# count only the photos that can be mapped, when filtered by Flickr
+# (photos.search can't filter by photoset, so photosets are paged whole)
+if search_geotagged_only and mode == 'photostream':
+    try:
+        photos = loop.run_until_complete(flickr_retry.callAsync('flickr', flickr_async.searchPhotos, user_id, privacy_filter=config.photo_privacy, content_types=0, per_page=1, use_cache=False, **sync_query, **photostream_filter))
+        geo_total = int(photos['photos']['total'])
+        total = min(total, geo_total)
+        print('{} geotagged photo(s) to be extracted'.format(total))
+        log_file.write('{} geotagged photo(s) to be extracted\n'.format(total))
+    except Exception as e:
+        print("ERROR: FATAL: Unable to get photos after {} tries".format(getattr(e, 'tries', max_tries)))
+        print(str(e))
+        log_file.write("ERROR: FATAL: Unable to get photos after {} tries\n".format(getattr(e, 'tries', max_tries)))
+        log_file.write('{}\n'.format(str(e)))
+        os.system("touch {}/fatal".format(run_path))
+        sys.exit()
 
+# tag of the cached pages, the numbers of photos counted on the run,
+# so the pages cached by a previous run are not used after photos were
+# added, removed or changed (geotagged, made private, ...) since then
+if mode == 'photoset':
+    pages_tag = total
+else:
+    pages_tag = [sync_total, geo_total]
 
 print('Extracting photo coordinates and ids...')
 log_file.write('Extracting photo coordinates and ids...\n')
@@ -285,8 +701,49 @@ npages = math.ceil(total/int(photos_per_page))
 n_photos = 0  # counts number of photos
 n_markers = 0 # counts number of markers
 
+# pages of the date windows, when the photostream is partitioned
+window_pages = []
+
+# function that fetches each page
+fetch_page = getPhotosPage
+
+# split a big photostream in date windows, each one paged on its
+# own, so all the photos are fetched without deep pagination (a
+# searched photostream is always split, the search can't be paged
+# beyond 'search_max_results' photos)
+if (partition_by_date or search_geotagged_only) and mode == 'photostream' and total > max_photos_per_window:
+    try:
+        first_date = int(user_info['person']['photos']['firstdate']['_content'])
+    except:
+        first_date = 0
+    min_date = max(first_date, sync_query.get('min_upload_date', 0))
+    try:
+        windows = loop.run_until_complete(getDateWindows(min_date, newest_upload_date))
+    except Exception as e:
+        print("ERROR: FATAL: Unable to get photos after {} tries".format(getattr(e, 'tries', max_tries)))
+        print(str(e))
+        log_file.write("ERROR: FATAL: Unable to get photos after {} tries\n".format(getattr(e, 'tries', max_tries)))
+        log_file.write('{}\n'.format(str(e)))
+        os.system("touch {}/fatal".format(run_path))
+        sys.exit()
+
+    for window in windows:
+        for window_page in range(1, math.ceil(window[2]/int(photos_per_page))+1):
+            window_pages.append([window[0], window[1], window_page, window[2]])
+
+    total = sum(window[2] for window in windows)
+    npages = len(window_pages)
+    fetch_page = getWindowPage
+    if partition_by_date:
+        max_number_of_photos = max(max_number_of_photos, total)
+    elif total > max_number_of_photos:
+        # the windows are fetched from the newest to the oldest one
+        total = max_number_of_photos
+    print("Extracting {} photos in {} date window(s)".format(total, len(windows)))
+    log_file.write("Extracting {} photos in {} date window(s)\n".format(total, len(windows)))
+
 # extracts only the photos below a number limit
-if npages > max_number_of_pages:
+elif npages > max_number_of_pages:
     npages = max_number_of_pages
     total = max_number_of_pages * int(photos_per_page);
     print("Extracting for the last {} photos".format(total))
@@ -295,158 +752,160 @@ if npages > max_number_of_pages:
 # counts the number of processed photos
 proc_photos = 0
 
-# process each page
-max_tries = 10
+# resume from the checkpoint of an interrupted run with the same
+# cursor, replaying the photos of the pages already processed
+extraction_checkpoint = Checkpoint(run_path, {'user_id': user_id, 'mode': mode, 'photoset_id': config.photoset_id, 'total': total, 'npages': npages, 'query': sync_query, 'windows': window_pages})
+saved_pages = extraction_checkpoint.loadPages()
 
-for pg in range(1, npages+1):
+# ids of the photos processed, the date windows may overlap
+# when photos are uploaded while they are fetched
+seen_ids = set()
 
-    # get photos according to run mode
-    for tries in range(1, max_tries+1):
-        try:
-            if mode == 'photoset':
-                page = flickr.photosets.getPhotos(api_key=api_key, user_id=user_id, photoset_id=config.photoset_id, privacy_filter=config.photo_privacy, content_types=0, extras='geo,tags,url_sq', page=pg, per_page=photos_per_page)['photoset']['photo']
-            else:
-                page = flickr.people.getPhotos(api_key=api_key, user_id=user_id, privacy_filter=config.photo_privacy, content_types=0, extras='geo,tags,url_sq', page=pg, per_page=photos_per_page)['photos']['photo']
-            break
-        except Exception as e:
-            if tries < max_tries:
-                print("ERROR: Unable to get photos")
-                print(str(e))
-                print('Trying again...')
-                log_file.write("ERROR: Unable to get photos\n")
-                log_file.write('{}\n'.format(str(e)))
-                log_file.write('Trying again...\n')
-            else:
-                print("ERROR: FATAL: Unable to get photos after {} tries".format(max_tries))
-                print(str(e))
-                log_file.write("ERROR: FATAL: Unable to get photos after {} tries\n".format(max_tries))
-                log_file.write('{}\n'.format(str(e)))
-                os.system("touch {}/fatal".format(run_path))
-                sys.exit()
-
-    photos_in_page = len(page)
+for saved_page in saved_pages:
+    for photo_info, new_marker in aggregateMarkers(saved_page['photos'], coords, marker_key, centroid, marker_store):
+        seen_ids.add(photo_info[2])
+        n_photos += 1
+        if new_marker:
+            n_markers += 1
+    proc_photos = saved_page['proc_photos']
+    sync_upload_date = max(sync_upload_date, saved_page['upload_date'])
+    sync_update_date = max(sync_update_date, saved_page['update_date'])
 
-    # process each photo on page
-    for ph in range(0, photos_in_page):
+first_page = len(saved_pages) + 1
 
-        photo = page[ph]
+if len(saved_pages) > 0:
+    print('Resuming from checkpoint | {0}/{1} batch(es) already processed'.format(len(saved_pages), npages))
+    log_file.write('Resuming from checkpoint | {0}/{1} batch(es) already processed\n'.format(len(saved_pages), npages))
+    if n_photos >= total or n_photos >= max_number_of_photos:
+        first_page = npages + 1
 
-        # variable to store information if already exist a marker
-        # on the same photo's coordinates
-        marker_exists = False
+extraction_checkpoint.open(saved_pages)
 
-        # check if photo can be included on the map (according to privacy settings)
-        if isGeoTagged(photo) and (config.geo_privacy == 0 or getGeoPrivacy(photo) == config.geo_privacy) and config.dont_map_tag.lower() not in photo['tags']:
+# stop processing photos if any limit was reached
+photos_limit = min(total, max_number_of_photos)
 
-            n_photos += 1
+# process each page, pages are fetched concurrently as tasks
+# on the event loop, but processed one by one in page order
+pages = pageSource(loop, fetch_page, first_page, npages, max_page_workers)
 
-            # get coordinates from photo
-            longitude = float(photo['longitude'])
-            latitude = float(photo['latitude'])
-
-            # read each markers coordinates and append photo in case
-            # there is already a marker on the same coordinate
-            for coord in coords:
-                if longitude == coord[0][0] and latitude == coord[0][1]:
-                    coord[1].append([photo['id'], photo['url_sq']])
-                    marker_exists = True
-                    break
-
-            # create a new marker to be added to the map
-            if not marker_exists:
-                coords.append([[longitude, latitude], [[photo['id'], photo['url_sq']]]])
-                n_markers += 1
+try:
+    for pg, page in pages:
 
-        proc_photos += 1
+        # photos of the page not processed yet, below the limit
+        page = [photo for photo in page if photo['id'] not in seen_ids]
+        page = page[:max(photos_limit - proc_photos, 0)]
+        proc_photos += len(page)
+        seen_ids.update(photo['id'] for photo in page)
 
-        # stop processing photos if any limit was reached
-        if proc_photos >= total or proc_photos >= max_number_of_photos:
-           break
+        # keep the high-water marks of the photos seen
+        for photo in page:
+            sync_upload_date = max(sync_upload_date, int(photo['dateupload']))
+            sync_update_date = max(sync_update_date, int(photo['lastupdate']))
 
-    print('Batch {0}/{1} | {2} photo(s) in {3} marker(s)'.format(pg, npages, n_photos, n_markers), end='\r')
-    log_file.write('Batch {0}/{1} | {2} photo(s) in {3} marker(s)\n'.format(pg, npages, n_photos, n_markers))
+        # photos taken from this page, to be saved on checkpoint
+        page_photos = []
 
-    # stop processing pages if any limit was reached
-    if n_photos >= total:
-        break
-    if n_photos >= max_number_of_photos:
-        print("\nMaximum number of photos on map reached!", end='')
-        log_file.write("Maximum number of photos on map reached!")
-        break
+        for photo_info, new_marker in aggregateMarkers(filterPhotos(page, config.geo_privacy, config.dont_map_tag), coords, marker_key, centroid, marker_store):
+            n_photos += 1
+            if new_marker:
+                n_markers += 1
+            page_photos.append(photo_info)
 
-print('\nAdding marker(s) to map...')
-log_file.write('Adding marker(s) to map...\n')
+        # save the page, a rerun will resume after it
+        extraction_checkpoint.addPage(pg, proc_photos, page_photos, upload_date=sync_upload_date, update_date=sync_update_date)
 
-# check if there is a file with the markers on map already
-# and import it otherwise created a new variable
-if os.path.exists("{}/locations.py".format(run_path)):
-    from locations import locations_dict
-else:
-    locations_dict = dict()
+        print('Batch {0}/{1} | {2} photo(s) in {3} marker(s)'.format(pg, npages, n_photos, n_markers), end='\r')
+        log_file.write('Batch {0}/{1} | {2} photo(s) in {3} marker(s)\n'.format(pg, npages, n_photos, n_markers))
 
-# get the number of markers (locations) already on map
-n_markers = getNumberOfMarkers(locations_dict)
-if n_markers > 0:
-    print('Map already has {} marker(s)'.format(n_markers))
-    log_file.write('Map already has {} marker(s)\n'.format(n_markers))
-
-# check if there is file with the countries already mapped
-if os.path.exists("{}/countries.py".format(run_path)):
-    from countries import countries_dict
-else:
-    countries_dict = dict()
+        # stop processing pages if any limit was reached
+        if n_photos >= total or proc_photos >= total:
+            break
+        if n_photos >= max_number_of_photos or proc_photos >= max_number_of_photos:
+            print("\nMaximum number of photos on map reached!", end='')
+            log_file.write("Maximum number of photos on map reached!")
+            break
 
+except Exception as e:
+    pages.close()
+    print("ERROR: FATAL: Unable to get photos after {} tries".format(getattr(e, 'tries', max_tries)))
+    print(str(e))
+    log_file.write("ERROR: FATAL: Unable to get photos after {} tries\n".format(getattr(e, 'tries', max_tries)))
+    log_file.write('{}\n'.format(str(e)))
+    os.system("touch {}/fatal".format(run_path))
+    sys.exit()
 
-# counts the number of new photos added to markers
-new_photos = 0
+# cancel the pages still in flight, they are not needed anymore
+pages.close()
 
-# iterate on each country
-for country in locations_dict:
+extraction_checkpoint.close()
 
-    # get markers for country
-    country_markers = locations_dict[country]
+# the upload mark is also taken from the newest photo on the photostream,
+# as the new photos are counted on the next run, so the photos filtered
+# out of the pages (not geotagged) are not counted as new again. Only if
+# all the photos of the pages were fetched, otherwise it stays on the
+# newest photo fetched and the next run looks for the missing ones
+if proc_photos >= total:
+    sync_upload_date = max(sync_upload_date, newest_upload_date)
 
-    # iterate on each marker
-    for marker in country_markers:
+# add the photos updated since the last run, the ones already
+# on the same marker are skipped when merging into the map
+for photo in updated_photos:
+    sync_update_date = max(sync_update_date, int(photo['lastupdate']))
 
-        # get info for photos on marker
-        photos_info = marker[1]
-        #n_photos = len(photos_info)
+# new photos are listed as updated too, they were processed already
+updated_photos = [photo for photo in updated_photos if photo['id'] not in seen_ids]
 
-        # get number of photos (coordinates) to be added to map
-        n_coords = len(coords)
+for photo_info, new_marker in aggregateMarkers(filterPhotos(updated_photos, config.geo_privacy, config.dont_map_tag, config.photo_privacy), coords, marker_key, centroid, marker_store):
+    n_photos += 1
+    if new_marker:
+        n_markers += 1
 
-        # iterate over each coordinate
-        for coord in range(n_coords-1, -1, -1):
+# fetch phase finished, release the connections pool
+loop.run_until_complete(flickr_async.close())
+loop.close()
 
-            # if there is already a marker on the same coordinate
-            if coords[coord][0] == marker[0]:
+print('\nAdding marker(s) to map...')
+log_file.write('Adding marker(s) to map...\n')
 
-                # read each photo already on the marker
-                for photo in coords[coord][1]:
-                    photo_id = photo[0]
-                    thumb_url = photo[1]
+# get the number of markers (locations) already on map
+n_markers = map_stats.n_markers
+if n_markers > 0:
+    print('Map already has {} marker(s)'.format(n_markers))
+    log_file.write('Map already has {} marker(s)\n'.format(n_markers))
 
-                    # if the photo is not already on marker, add the photo to it
-                    if [photo_id, thumb_url] not in photos_info:
-                        photos_info.append([photo_id, thumb_url])
-                        new_photos += 1
 
-                # remove photo info from
-                # coordinates to be added
-                coords.pop(coord)
+# counts the number of new photos added to markers
+new_photos = 0
 
-        # update the number of photos on marker
-        marker[1] = photos_info
+# markers not on map yet, the coordinates order is reversed
+# so the newest ones go to the end
+pending_markers = []
+
+# index of the markers on map by coordinates, built once so
+# each new marker is merged or queued in constant time
+markers_index = buildMarkersIndex(locations_dict, marker_key)
+
+for marker_info, new_marker, added, position, country_code in mergeMarkers(reversed(coords.values()), markers_index, marker_key, centroid):
+    new_photos += added
+    if new_marker:
+        pending_markers.append(marker_info)
+    elif added > 0:
+        map_stats.addPhotos(country_code, added)
+        map_db.addPhotos(marker_info.id, list(marker_info[1])[-added:])
+        if centroid:
+            map_db.moveMarker(marker_info.id, marker_info[0])
+        if cluster_index is not None:
+            # the marker may have moved to the centroid of its photos
+            cluster_index.removeMarker(position, len(marker_info[1]) - added)
+            cluster_index.addMarker(marker_info[0], len(marker_info[1]))
+
+# the markers index is not needed anymore
+coords = pending_markers
 
 if new_photos > 0:
     print('Added {} new photo(s) to existing markers'.format(new_photos))
     log_file.write('Added {} new photo(s) to existing markers\n'.format(new_photos))
 
-# reverse the coordinates order so
-# the newest ones go to the end
-coords.reverse()
-
 # check if there is remaining markers to be added
 n_markers = len(coords)
 if n_markers > 0:
@@ -465,12 +924,11 @@ for marker_info in coords:
     latitude = float(marker_info[0][1])
 
     # get country code and name
-    country_info = getCountryInfo(latitude, longitude, matrix_dict, coords_dict)
+    country_info = getCountryInfo(latitude, longitude, matrix_grid)
     country_code = country_info[0]
     country_name = country_info[1]
     if update_matrix:
-        matrix_dict = country_info[2]
-    coords_dict = country_info[3]
+        matrix_grid = country_info[2]
 
     # add country to countries dictionary
     if country_code != '' and country_code != '*':
@@ -486,6 +944,11 @@ for marker_info in coords:
     else:
         locations_dict[country_code].append(marker_info)
 
+    map_stats.addMarker(country_code, len(marker_info[1]))
+    map_db.addMarker(country_code, marker_info)
+    if cluster_index is not None:
+        cluster_index.addMarker(marker_info[0], len(marker_info[1]))
+
     print('Added marker {0}/{1}'.format(new_markers, n_markers), end='\r')
     log_file.write('Added marker {0}/{1}\n'.format(new_markers, n_markers))
 
@@ -496,110 +959,134 @@ else:
     print('No new markers were added to the map')
     log_file.write('No new markers were added to the map\n')
 
+# compare the counters with a full count of the map
+if check_counters:
+    for error in map_stats.check(locations_dict):
+        print("ERROR: Counters mismatch: {}".format(error))
+        log_file.write("ERROR: Counters mismatch: {}\n".format(error))
+
 print('Finished!')
 log_file.write('Finished!\n')
 
-# write countries dictionary to file
-countries_file = open("{}/countries.py".format(run_path), 'w')
-countries_file.write("countries_dict = {\n")
-
-i = 0
-for code in countries_dict:
-    markers = locations_dict[code]
-    n_markers = len(markers)
-    n_photos = 0
-    for marker in markers:
-        n_photos += len(marker[1])
+# report how long the calls waited on the rate limiters
+for line in getReport():
+    print(line)
+    log_file.write('{}\n'.format(line))
 
-    countries_dict[code][1] = n_markers
-    countries_dict[code][2] = n_photos
+# report the use of the responses cache
+if flickr_cache is not None:
+    for line in flickr_cache.getReport():
+        print(line)
+        log_file.write('{}\n'.format(line))
 
-    if i < len(countries_dict)-1:
-        countries_file.write("  \'{0}\': {1},\n".format(code, countries_dict[code]))
-    else:
-        countries_file.write("  \'{0}\': {1}\n".format(code, countries_dict[code]))
-    i += 1
+# numbers of markers and photos of each country
+for code in countries_dict:
+    countries_dict[code][1:] = map_stats.getCountry(code)
 
-countries_file.write("}\n")
-countries_file.close()
+closeGeocodeStore()
 
-# write markers information (locations) to file
-locations_file = open("{}/locations.py".format(run_path), 'w')
-locations_file.write("locations_dict = {\n")
-
-i = 1
-for country_code in locations_dict:
-    locations_file.write("  \'{}\': [\n".format(country_code))
-    random.shuffle(locations_dict[country_code])
-    for coord in range(len(locations_dict[country_code])):
-        locations_file.write("    {}".format(locations_dict[country_code][coord]))
-        if coord < len(locations_dict[country_code])-1:
-            locations_file.write(",\n")
-        else:
-            locations_file.write("\n  ]")
-    if i < len(locations_dict):
-        locations_file.write(",\n")
-    else:
-        locations_file.write("\n")
-    i += 1
-
-locations_file.write("}\n")
-locations_file.close()
-
-if update_matrix:
-    # write matrix dictionary to file
-    matrix_file = open("{}/matrix.py".format(run_path), 'w')
-    matrix_file.write("matrix_dict = {\n")
-
-    i = 1
-    for key in matrix_dict:
-        matrix_file.write("  \'{}\': {}".format(key, matrix_dict[key]))
-        if i < len(matrix_dict):
-            matrix_file.write(",\n")
-        else:
-            matrix_file.write("\n")
-        i += 1
+# export the map files, the files with no changes on the run are not
+# written again. They are written before the state of the map is saved,
+# so if the run stops in between, the next one finds the same changes
+# and writes them again
 
-    matrix_file.write("}\n")
-    matrix_file.close()
+# write countries dictionary to file
+if countries_dict != loaded_countries or not os.path.exists("{}/countries.py".format(run_path)):
+    with AtomicFile("{}/countries.py".format(run_path)) as countries_file:
+        countries_file.write("countries_dict = {\n")
+
+        i = 0
+        for code in countries_dict:
+            if i < len(countries_dict)-1:
+                countries_file.write("  \'{0}\': {1},\n".format(code, countries_dict[code]))
+            else:
+                countries_file.write("  \'{0}\': {1}\n".format(code, countries_dict[code]))
+            i += 1
 
-# write coordinates dictionary to file
-coordinates_file = open("{}/coords.py".format(run_path), 'w')
-coordinates_file.write("coords_dict = {\n")
+        countries_file.write("}\n")
 
-i = 1
-for key in coords_dict:
-    coordinates_file.write("  \'{}\': {}".format(key, coords_dict[key]))
-    if i < len(coords_dict):
-        coordinates_file.write(",\n")
-    else:
-        coordinates_file.write("\n")
-    i += 1
-
-coordinates_file.write("}\n")
-coordinates_file.close()
+# write markers information (locations) to file
+if len(map_stats.changed) > 0 or not os.path.exists("{}/locations.py".format(run_path)):
+    with AtomicFile("{}/locations.py".format(run_path)) as locations_file:
+        locations_file.write("locations_dict = {\n")
+
+        i = 1
+        for country_code in locations_dict:
+            locations_file.write("  \'{}\': [\n".format(country_code))
+            locations_dict[country_code].sort(key=getSpreadKey)
+            for coord in range(len(locations_dict[country_code])):
+                locations_file.write("    {}".format(locations_dict[country_code][coord]))
+                if coord < len(locations_dict[country_code])-1:
+                    locations_file.write(",\n")
+                else:
+                    locations_file.write("\n  ]")
+            if i < len(locations_dict):
+                locations_file.write(",\n")
+            else:
+                locations_file.write("\n")
+            i += 1
+
+        locations_file.write("}\n")
+
+# write the markers as GeoJSON, in the same order of the locations file
+if export_geojson:
+    if len(map_stats.changed) > 0 or not os.path.exists("{}/{}".format(run_path, geojson_file_name)):
+        writeLocationsGeoJson("{}/{}".format(run_path, geojson_file_name), locations_dict)
+elif os.path.exists("{}/{}".format(run_path, geojson_file_name)):
+    # the map would load the markers from it
+    os.remove("{}/{}".format(run_path, geojson_file_name))
+
+# write the clusters of markers next to the locations file
+if cluster_index is not None:
+    if cluster_index.changed or not os.path.exists("{}/clusters.py".format(run_path)):
+        cluster_index.writeFile("{}/clusters.py".format(run_path))
+elif os.path.exists("{}/clusters.py".format(run_path)):
+    # the map would show clusters that are out of date
+    os.remove("{}/clusters.py".format(run_path))
+
+if update_matrix and matrix_grid.changed:
+    # write matrix dictionary to file, then the grid
+    # so it is not converted again on the next run
+    writeMatrixFile("{}/matrix.py".format(run_path), matrix_grid)
+    matrix_grid.save("{}/{}".format(run_path, grid_file_name))
 
 # get total number of markers and photos to write to user file
-n_markers = getNumberOfMarkers(locations_dict)
-n_photos = getNumberOfPhotos(locations_dict)
+n_markers = map_stats.n_markers
+n_photos = map_stats.n_photos
 n_countries = len(countries_dict)
 
 # write user information to file
-
-user_file = open("{}/user.py".format(run_path), 'w')
-user_file.write("user_info = {\n")
-user_file.write("  \'id\': \'{}\',\n".format(user_id))
-user_file.write("  \'alias\': \'{}\',\n".format(user_alias))
-user_file.write("  \'name\': \'{}\',\n".format(user_name.replace("\'", "\\\'")))
-user_file.write("  \'avatar\': \'{}\',\n".format(user_avatar))
-user_file.write("  \'url\': \'{}\',\n".format(photos_base_url))
-user_file.write("  \'location\': \'{}\',\n".format(user_location))
-user_file.write("  \'countries\': {},\n".format(n_countries))
-user_file.write("  \'markers\': {},\n".format(n_markers))
-user_file.write("  \'photos\': {}\n".format(n_photos))
-user_file.write("}\n")
-user_file.close()
+user_lines = []
+user_lines.append("user_info = {\n")
+user_lines.append("  \'id\': \'{}\',\n".format(user_id))
+user_lines.append("  \'alias\': \'{}\',\n".format(user_alias))
+user_lines.append("  \'name\': \'{}\',\n".format(user_name.replace("\'", "\\\'")))
+user_lines.append("  \'avatar\': \'{}\',\n".format(user_avatar))
+user_lines.append("  \'url\': \'{}\',\n".format(photos_base_url))
+user_lines.append("  \'location\': \'{}\',\n".format(user_location))
+user_lines.append("  \'countries\': {},\n".format(n_countries))
+user_lines.append("  \'markers\': {},\n".format(n_markers))
+user_lines.append("  \'photos\': {}\n".format(n_photos))
+user_lines.append("}\n")
+writeFileIfChanged("{}/user.py".format(run_path), ''.join(user_lines))
 
 updateLastTotalFile(run_path, current_total)
 
+if mode == 'photostream':
+    updateLastSyncFile(run_path, sync_upload_date, sync_update_date, sync_total)
+
+# save the state of the map, all the changes
+# of the run are committed at once
+map_db.saveCountries(countries_dict)
+map_db.setSync('last_total', current_total)
+if mode == 'photostream':
+    map_db.setSync('upload_date', sync_upload_date)
+    map_db.setSync('update_date', sync_update_date)
+    map_db.setSync('total', sync_total)
+map_db.commit()
+map_db.close()
+
+# the map files are complete, the checkpoint is not needed anymore
+extraction_checkpoint.remove()
+
 log_file.close()
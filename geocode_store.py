@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+# On-disk store of the geocoded coordinates, replacing the dictionary
+# of 'coords.py' that was imported whole at startup and rewritten at
+# the end of every run. The coordinates are kept in the SQLite file
+# 'geocodes.db', keyed by 'latitude,longitude', so a lookup reads a
+# single entry and a new coordinate is a single insert. The entries
+# are committed every 'commit_interval' inserts and when the store is
+# closed, so the results of the geocoders are kept even if the run is
+# interrupted.
+#
+# The store is created from 'coords.py' the first time it is opened.
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+import os
+import sqlite3
+import sys
+
+
+# ================= CONFIGURATION VARIABLES =====================
+
+store_file_name = 'geocodes.db'
+
+# Inserts between commits
+commit_interval = 100
+
+
+# ===============================================================
+
+class GeocodeStore:
+
+    def __init__(self, run_path):
+        self.file_path = "{}/{}".format(run_path, store_file_name)
+        created = not os.path.exists(self.file_path)
+        self.connection = sqlite3.connect(self.file_path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS geocodes (key TEXT PRIMARY KEY, code TEXT NOT NULL, name TEXT NOT NULL)")
+        self.pending = 0
+        if created and os.path.exists("{}/coords.py".format(run_path)):
+            if run_path not in sys.path:
+                sys.path.insert(0, run_path)
+            from coords import coords_dict
+            self.connection.executemany("INSERT OR REPLACE INTO geocodes (key, code, name) VALUES (?, ?, ?)", ((key, value[0], value[1]) for key, value in coords_dict.items()))
+        self.connection.commit()
+
+    def getKey(self, latlong):
+        return "{},{}".format(latlong[0], latlong[1])
+
+    # Get [code, name] of a coordinate, or ['', ''] if it's not stored
+    def get(self, latlong):
+        row = self.connection.execute("SELECT code, name FROM geocodes WHERE key = ?", (self.getKey(latlong),)).fetchone()
+        if row is None:
+            return ['', '']
+        return list(row)
+
+    def put(self, latlong, country_info):
+        self.connection.execute("INSERT OR REPLACE INTO geocodes (key, code, name) VALUES (?, ?, ?)", (self.getKey(latlong), country_info[0], country_info[1]))
+        self.pending += 1
+        if self.pending >= commit_interval:
+            self.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM geocodes").fetchone()[0]
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+
+# Export of the markers as GeoJSON, a FeatureCollection with a Point
+# feature for each marker, its country and photos as properties:
+#
+#   {"type": "FeatureCollection", "features": [
+#   {"type": "Feature", "geometry": {"type": "Point", "coordinates": [longitude, latitude]},
+#    "properties": {"country": "BR", "photos": [[id, url], ...]}},
+#   ...
+#   ]}
+#
+# The features are streamed to the file one marker at a time, so the
+# whole document is never built in memory, and written atomically. The
+# features are in the order of the markers on 'locations_dict', grouped
+# by country.
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+import json
+
+from atomic_file import AtomicFile
+from marker_store import Marker
+
+
+# ================= CONFIGURATION VARIABLES =====================
+
+geojson_file_name = 'locations.geojson'
+
+
+# ===============================================================
+
+encoder = json.JSONEncoder(separators=(',', ':'))
+
+feature_format = '{{"type":"Feature","geometry":{{"type":"Point","coordinates":[{!r},{!r}]}},"properties":{{"country":{},"photos":{}}}}}'
+
+# Get the json of the photos of a marker, reading the columns of the
+# store directly for the markers views, without building the lists
+def encodePhotos(marker):
+    if not isinstance(marker, Marker):
+        return encoder.encode([[photo[0], photo[1]] for photo in marker[1]])
+    store = marker.store
+    photos = []
+    row = store.first_photo[marker.index]
+    while row >= 0:
+        if store.server[row] < 0:
+            thumb_url = encoder.encode(store.other_urls[row])
+        else:
+            # the urls rebuilt from the thumbnails format need no escaping
+            thumb_url = '"' + store.getThumbUrl(row) + '"'
+        photos.append('["{}",{}]'.format(store.photo_id[row], thumb_url))
+        row = store.next_photo[row]
+    return '[' + ','.join(photos) + ']'
+
+def getPosition(marker):
+    if isinstance(marker, Marker):
+        return [marker.store.longitude[marker.index], marker.store.latitude[marker.index]]
+    return marker[0]
+
+# Write the markers of a locations dictionary as GeoJSON,
+# returns the number of features written
+def writeLocationsGeoJson(file_path, locations_dict):
+    n_features = 0
+    with AtomicFile(file_path) as geojson_file:
+        geojson_file.write('{"type":"FeatureCollection","features":[\n')
+        for country_code in locations_dict:
+            country = encoder.encode(country_code)
+            for marker in locations_dict[country_code]:
+                if n_features > 0:
+                    geojson_file.write(',\n')
+                position = getPosition(marker)
+                geojson_file.write(feature_format.format(float(position[0]), float(position[1]), country, encodePhotos(marker)))
+                n_features += 1
+        geojson_file.write('\n]}\n')
+    return n_features
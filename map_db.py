@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+# SQLite database with the state of the map: the markers and their
+# photos, the countries and the values of the last sync (the countries
+# matrix and the geocoded coordinates are kept in their own stores, see
+# country_grid.py and geocode_store.py).
+#
+# The markers and photos are updated as they change (markers added,
+# photos merged or removed) instead of rewritten, and all the changes
+# of a run are committed in a single transaction at its end, so an
+# interrupted run leaves the database as it was. The files read by
+# 'index.html' ('locations.py', 'countries.py', ...) are exports of the
+# state, written before it is committed, so a run interrupted between
+# them leaves the changes to be found and written again.
+#
+# On the first run the state is migrated from the files of the previous
+# versions, see MapDatabase.created.
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+import sqlite3
+
+
+# ================= CONFIGURATION VARIABLES =====================
+
+database_file_name = 'map.db'
+
+# version of the tables, saved once the state is migrated
+database_version = 1
+
+
+# ===============================================================
+
+schema = """
+CREATE TABLE IF NOT EXISTS markers (
+  id INTEGER PRIMARY KEY,
+  country TEXT NOT NULL,
+  longitude REAL NOT NULL,
+  latitude REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS markers_country ON markers (country);
+CREATE TABLE IF NOT EXISTS photos (
+  row INTEGER PRIMARY KEY,
+  id INTEGER NOT NULL,
+  marker INTEGER NOT NULL,
+  thumb_url TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS photos_id ON photos (id);
+CREATE INDEX IF NOT EXISTS photos_marker ON photos (marker);
+CREATE TABLE IF NOT EXISTS countries (
+  code TEXT PRIMARY KEY,
+  name TEXT NOT NULL,
+  markers INTEGER NOT NULL,
+  photos INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync (
+  key TEXT PRIMARY KEY,
+  value INTEGER NOT NULL
+);
+"""
+
+
+class MapDatabase:
+
+    def __init__(self, run_path):
+        self.file_path = "{}/{}".format(run_path, database_file_name)
+        self.connection = sqlite3.connect(self.file_path)
+        self.connection.executescript(schema)
+        self.connection.commit()
+        # True if the state was not migrated to the database yet
+        self.created = self.getSync('version') is None
+
+    # Commit the state migrated from the files
+    def finishMigration(self):
+        self.setSync('version', database_version)
+        self.commit()
+        self.created = False
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    #===== MARKERS ============================================================#
+
+    # Load the markers on a MarkerStore, returns the locations dictionary
+    # with their views, in the order they were added
+    def loadLocations(self, store):
+        locations_dict = dict()
+        photos = self.connection.execute("SELECT marker, id, thumb_url FROM photos ORDER BY marker, row")
+        photo = photos.fetchone()
+        for marker_id, country_code, longitude, latitude in self.connection.execute("SELECT id, country, longitude, latitude FROM markers ORDER BY id"):
+            # both are sorted by marker, so the photos of each
+            # marker are read as the markers are
+            marker_photos = []
+            while photo is not None and photo[0] <= marker_id:
+                if photo[0] == marker_id:
+                    marker_photos.append([str(photo[1]), photo[2]])
+                photo = photos.fetchone()
+            marker = store.addMarker([[longitude, latitude], marker_photos])
+            marker.id = marker_id
+            if country_code not in locations_dict:
+                locations_dict[country_code] = [marker]
+            else:
+                locations_dict[country_code].append(marker)
+        return locations_dict
+
+    # Add a marker on a country, setting its id
+    def addMarker(self, country_code, marker):
+        cursor = self.connection.execute("INSERT INTO markers (country, longitude, latitude) VALUES (?, ?, ?)", (country_code, marker[0][0], marker[0][1]))
+        marker.id = cursor.lastrowid
+        self.addPhotos(marker.id, marker[1])
+
+    # Add all the markers of a locations dictionary
+    def addLocations(self, locations_dict):
+        for country_code in locations_dict:
+            for marker in locations_dict[country_code]:
+                self.addMarker(country_code, marker)
+
+    def addPhotos(self, marker_id, photos):
+        self.connection.executemany("INSERT INTO photos (id, marker, thumb_url) VALUES (?, ?, ?)", ((int(photo[0]), marker_id, photo[1]) for photo in photos))
+
+    def moveMarker(self, marker_id, position):
+        self.connection.execute("UPDATE markers SET longitude = ?, latitude = ? WHERE id = ?", (position[0], position[1], marker_id))
+
+    def removeMarker(self, marker_id):
+        self.connection.execute("DELETE FROM photos WHERE marker = ?", (marker_id,))
+        self.connection.execute("DELETE FROM markers WHERE id = ?", (marker_id,))
+
+    def removePhotos(self, photo_ids):
+        self.connection.executemany("DELETE FROM photos WHERE id = ?", ((int(photo_id),) for photo_id in photo_ids))
+
+    #===== COUNTRIES ==========================================================#
+
+    def loadCountries(self):
+        return {code: [name, n_markers, n_photos] for code, name, n_markers, n_photos in self.connection.execute("SELECT code, name, markers, photos FROM countries ORDER BY rowid")}
+
+    def saveCountries(self, countries_dict):
+        self.connection.execute("DELETE FROM countries")
+        self.connection.executemany("INSERT INTO countries (code, name, markers, photos) VALUES (?, ?, ?, ?)", ((code, info[0], info[1], info[2]) for code, info in countries_dict.items()))
+
+    #===== SYNC ===============================================================#
+
+    def getSync(self, key, default=None):
+        row = self.connection.execute("SELECT value FROM sync WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def setSync(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO sync (key, value) VALUES (?, ?)", (key, int(value)))
@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+
+# Stages of the photos extraction, written as generators so the photos
+# stream through them one page at a time:
+#
+#   pageSource -> filterPhotos -> aggregateMarkers -> mergeMarkers
+#
+# pageSource yields the pages fetched from Flickr, filterPhotos yields the
+# photos that can be included on the map, aggregateMarkers groups them in
+# markers by coordinates and mergeMarkers adds the markers to the ones
+# already on the map, yielding the ones that are new. Only the pages in
+# flight and the markers index are kept in memory, and each stage can be
+# run (and benchmarked) on its own with any iterable as input.
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+import asyncio
+import hashlib
+
+from spatial_index import SpatialIndex
+
+
+# Function to get photo's geo privacy
+def getGeoPrivacy(photo):
+    if photo['geo_is_public'] == 1:
+        return 1
+    if photo['geo_is_contact'] == 1:
+        return 2
+    if photo['geo_is_friend'] == 1 and photo['geo_is_family'] == 0:
+        return 3
+    if photo['geo_is_friend'] == 0 and photo['geo_is_family'] == 1:
+        return 4
+    if photo['geo_is_friend'] == 1 and photo['geo_is_family'] == 1:
+        return 5
+    if photo['geo_is_friend'] == 0 and photo['geo_is_family'] == 0:
+        return 6
+
+# Function to get photo's privacy, same values of 'photo_privacy'
+def getPhotoPrivacy(photo):
+    if photo['ispublic'] == 1:
+        return 1
+    if photo['isfriend'] == 1 and photo['isfamily'] == 0:
+        return 2
+    if photo['isfriend'] == 0 and photo['isfamily'] == 1:
+        return 3
+    if photo['isfriend'] == 1 and photo['isfamily'] == 1:
+        return 4
+    return 5
+
+# Function to verify if there is geo tag info
+def isGeoTagged(photo):
+    if photo['latitude'] == 0 and photo['longitude'] == 0 and photo['accuracy'] == 0:
+        return False
+    return True
+
+# Function to verify if photo can be included on the map
+# (according to privacy settings and the dont map tag)
+def isMappable(photo, geo_privacy, dont_map_tag):
+    if not isGeoTagged(photo):
+        return False
+    if geo_privacy != 0 and getGeoPrivacy(photo) != geo_privacy:
+        return False
+    return dont_map_tag.lower() not in photo['tags']
+
+#===== MARKERS KEYS ===========================================================#
+
+geohash_base32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Encode a position as a geohash with 'precision' characters
+def encodeGeohash(latitude, longitude, precision):
+    lat_range = [-90.0, 90.0]
+    long_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    n_bits = 0
+    even = True
+    while len(geohash) < precision:
+        if even:
+            value, value_range = longitude, long_range
+        else:
+            value, value_range = latitude, lat_range
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = bits * 2 + 1
+            value_range[0] = middle
+        else:
+            bits = bits * 2
+            value_range[1] = middle
+        even = not even
+        n_bits += 1
+        if n_bits == 5:
+            geohash.append(geohash_base32[bits])
+            bits = 0
+            n_bits = 0
+    return ''.join(geohash)
+
+# Key of a marker on the exact coordinates of the photos
+def getExactKey(longitude, latitude):
+    return (longitude, latitude)
+
+# Key of the marker a photo belongs to when merging by distance: the
+# position of the nearest marker up to 'distance' meters away, found on
+# a spatial index, or the photo's own position if there is none, which
+# is then added to the index as a new marker
+class DistanceKey:
+
+    def __init__(self, distance):
+        self.distance = distance
+        self.index = SpatialIndex()
+
+    # Add the markers already on map, so the photos are merged into them
+    def load(self, locations_dict):
+        self.index.load([marker[0][0], marker[0][1], (marker[0][0], marker[0][1])]
+                        for country in locations_dict for marker in locations_dict[country])
+
+    def __call__(self, longitude, latitude):
+        found = self.index.nearest(longitude, latitude, self.distance)
+        if found is not None:
+            return found[0]
+        key = (longitude, latitude)
+        self.index.insert(longitude, latitude, key)
+        return key
+
+    # Get the key of a position without adding it as a new marker,
+    # to compare positions (the key it would get if there is no
+    # marker near it)
+    def lookup(self, longitude, latitude):
+        found = self.index.nearest(longitude, latitude, self.distance)
+        if found is not None:
+            return found[0]
+        return (longitude, latitude)
+
+    # Remove a marker taken out of the map, so photos are not merged into it
+    def remove(self, longitude, latitude):
+        return self.index.remove(longitude, latitude, (longitude, latitude))
+
+# Get the function that gives the key of the marker a photo belongs to:
+# '' = the exact coordinates, 'decimals' = coordinates rounded to
+# 'snap_precision' decimal places, 'geohash' = geohash cell with
+# 'snap_precision' characters, 'distance' = the nearest marker up to
+# 'snap_distance' meters away (see DistanceKey). All the photos with
+# the same key are merged in the same marker
+def getMarkerKeyFunction(snap_mode, snap_precision, snap_distance=25):
+    if snap_mode == 'decimals':
+        return lambda longitude, latitude: (round(longitude, snap_precision), round(latitude, snap_precision))
+    if snap_mode == 'geohash':
+        return lambda longitude, latitude: encodeGeohash(latitude, longitude, snap_precision)
+    if snap_mode == 'distance':
+        return DistanceKey(snap_distance)
+    return getExactKey
+
+# Sort key that spreads the markers evenly, but always in the same order:
+# a hash of the marker's position. Written in this order, the markers of
+# a country are spread over its area when the map loads them round robin,
+# and a marker only changes its place on the file if it moves
+def getSpreadKey(marker):
+    position = "{},{}".format(marker[0][0], marker[0][1]).encode()
+    return hashlib.blake2b(position, digest_size=8).digest()
+
+# Move a marker with 'n_photos' photos to the centroid of its photos, after
+# adding 'n_added' photos centered at 'longitude' and 'latitude'. As the
+# snapping cells are rectangles, the centroid never leaves the marker's cell
+# (when merging by distance, the marker's key stays on its first position)
+def moveToCentroid(marker, n_photos, longitude, latitude, n_added):
+    n_total = n_photos + n_added
+    marker[0] = [round((marker[0][0] * n_photos + longitude * n_added) / n_total, 6),
+                 round((marker[0][1] * n_photos + latitude * n_added) / n_total, 6)]
+
+# Add a photo to the markers to be added to the map, appending it to
+# the marker with the same key if there is one already. 'coords' is a
+# dictionary of markers indexed by 'marker_key' (exact coordinates by
+# default), so the marker is found in constant time and the markers
+# keep the order they were created. A merged marker stays on its first
+# photo's position unless 'centroid' is set. If a MarkerStore is given,
+# the new markers are created on it.
+# Returns True if a new marker was created
+def addPhotoToCoords(coords, longitude, latitude, photo_id, thumb_url, marker_key=getExactKey, centroid=False, store=None):
+    key = marker_key(longitude, latitude)
+    if key in coords:
+        marker = coords[key]
+        if centroid:
+            moveToCentroid(marker, len(marker[1]), longitude, latitude, 1)
+        marker[1].append([photo_id, thumb_url])
+        return False
+
+    # create a new marker to be added to the map
+    if store is not None:
+        coords[key] = store.addMarker([[longitude, latitude], [[photo_id, thumb_url]]])
+    else:
+        coords[key] = [[longitude, latitude], [[photo_id, thumb_url]]]
+    return True
+
+
+#===== STAGES =================================================================#
+
+# Yield [page number, photos] for pages 'first_page' to 'npages' in order.
+# 'fetch_page' is a coroutine function that gets a page, up to 'max_workers'
+# pages are fetched concurrently on 'loop'. When the consumer stops early
+# (or a page fails) the pages still in flight are cancelled
+def pageSource(loop, fetch_page, first_page, npages, max_workers):
+    pending_pages = dict()
+    next_page = first_page
+    try:
+        for pg in range(first_page, npages+1):
+            # keep up to 'max_workers' pages in flight
+            while next_page <= npages and next_page < pg + max_workers:
+                pending_pages[next_page] = loop.create_task(fetch_page(next_page))
+                next_page += 1
+            yield [pg, loop.run_until_complete(pending_pages.pop(pg))]
+    finally:
+        for task in pending_pages.values():
+            task.cancel()
+        if len(pending_pages) > 0 and not loop.is_running():
+            loop.run_until_complete(asyncio.gather(*pending_pages.values(), return_exceptions=True))
+
+# Yield [longitude, latitude, id, thumbnail url] of the photos that can be
+# included on the map. If 'photo_privacy' is given, photos with a different
+# privacy are also left out (the pages are usually filtered by Flickr)
+def filterPhotos(photos, geo_privacy, dont_map_tag, photo_privacy=0):
+    for photo in photos:
+        if photo_privacy != 0 and getPhotoPrivacy(photo) != photo_privacy:
+            continue
+        if isMappable(photo, geo_privacy, dont_map_tag):
+            yield [float(photo['longitude']), float(photo['latitude']), photo['id'], photo['url_sq']]
+
+# Add each photo to the markers index 'coords' (see addPhotoToCoords), yielding
+# [photo, True if a new marker was created]
+def aggregateMarkers(photos, coords, marker_key=getExactKey, centroid=False, store=None):
+    for photo in photos:
+        yield [photo, addPhotoToCoords(coords, photo[0], photo[1], photo[2], photo[3], marker_key, centroid, store)]
+
+# Build an index of the markers on map by 'marker_key', if two markers
+# have the same key the first one found is indexed. Each entry is
+# [marker, set of the ids of its photos, country code], the set is only
+# built when the first photo is merged into the marker
+def buildMarkersIndex(locations_dict, marker_key=getExactKey):
+    markers_index = dict()
+    for country in locations_dict:
+        for marker in locations_dict[country]:
+            key = marker_key(marker[0][0], marker[0][1])
+            if key not in markers_index:
+                markers_index[key] = [marker, None, country]
+    return markers_index
+
+# Merge each marker into the marker with the same key already on the
+# map, found on 'markers_index' (see buildMarkersIndex), adding the photos
+# not on it yet. Yields [marker, True if it is not on the map, number of
+# photos added to the marker on map, position of the marker before merging,
+# country code of the marker on map (None if it is not on the map)]
+def mergeMarkers(markers, markers_index, marker_key=getExactKey, centroid=False):
+    for marker_info in markers:
+
+        entry = markers_index.get(marker_key(marker_info[0][0], marker_info[0][1]))
+
+        if entry is None:
+            yield [marker_info, True, 0, marker_info[0], None]
+            continue
+
+        map_marker = entry[0]
+        if entry[1] is None:
+            entry[1] = set(photo[0] for photo in map_marker[1])
+        photo_ids = entry[1]
+
+        # if the photo is not already on marker, add the photo to it
+        position = map_marker[0]
+        n_photos = len(map_marker[1])
+        added = 0
+        for photo in marker_info[1]:
+            if photo[0] not in photo_ids:
+                map_marker[1].append(photo)
+                photo_ids.add(photo[0])
+                added += 1
+
+        if centroid and added > 0:
+            moveToCentroid(map_marker, n_photos, marker_info[0][0], marker_info[0][1], added)
+
+        yield [map_marker, False, added, position, entry[2]]
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+# Counters of the markers and photos on map, in total and by country,
+# kept up to date as markers and photos are added or removed, so the
+# totals written to 'user.py' and 'countries.py' don't need to scan all
+# the markers again. The counters are built once from the markers on
+# map and check() compares them with a full count, for debugging. The
+# countries with changes since they were built are kept in 'changed'.
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+class MapStats:
+
+    def __init__(self):
+        self.n_markers = 0
+        self.n_photos = 0
+        # country code -> [markers, photos]
+        self.countries = dict()
+        self.changed = set()
+
+    # Count the markers already on a locations dictionary
+    def build(self, locations_dict):
+        for country_code in locations_dict:
+            for marker in locations_dict[country_code]:
+                self.addMarker(country_code, len(marker[1]))
+        self.changed = set()
+
+    def update(self, country_code, n_markers, n_photos):
+        self.n_markers += n_markers
+        self.n_photos += n_photos
+        self.changed.add(country_code)
+        country = self.countries.get(country_code)
+        if country is None:
+            country = [0, 0]
+            self.countries[country_code] = country
+        country[0] += n_markers
+        country[1] += n_photos
+        if country[0] <= 0:
+            del self.countries[country_code]
+
+    def addMarker(self, country_code, n_photos):
+        self.update(country_code, 1, n_photos)
+
+    def removeMarker(self, country_code, n_photos):
+        self.update(country_code, -1, -n_photos)
+
+    # Add (or remove, if negative) photos to a marker that stays on map
+    def addPhotos(self, country_code, n_photos):
+        self.update(country_code, 0, n_photos)
+
+    # Get [markers, photos] of a country
+    def getCountry(self, country_code):
+        return list(self.countries.get(country_code, [0, 0]))
+
+    # Compare the counters with a full count of the markers on a locations
+    # dictionary, returns the list of differences found (empty if none)
+    def check(self, locations_dict):
+        expected = MapStats()
+        expected.build(locations_dict)
+        errors = []
+        if expected.n_markers != self.n_markers:
+            errors.append("markers: counted {}, expected {}".format(self.n_markers, expected.n_markers))
+        if expected.n_photos != self.n_photos:
+            errors.append("photos: counted {}, expected {}".format(self.n_photos, expected.n_photos))
+        for country_code in sorted(set(self.countries) | set(expected.countries)):
+            if self.getCountry(country_code) != expected.getCountry(country_code):
+                errors.append("country '{}': counted {}, expected {}".format(country_code, self.getCountry(country_code), expected.getCountry(country_code)))
+        return errors
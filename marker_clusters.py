@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+
+# Hierarchical clusters of the markers, one level per zoom, in the same
+# way as supercluster: at each zoom the world (in Web Mercator pixels) is
+# split in a grid of cells 'radius' pixels wide and the markers in a cell
+# form a cluster at their centroid. The cells of a zoom are split in 2x2
+# cells on the next one, so the levels nest like a quadtree.
+#
+# Each cluster keeps the sums of its markers' positions and counts, so
+# markers and photos can be added or removed in O(number of zooms),
+# without clustering the whole map again. The index is written to
+# 'clusters.py', next to 'locations.py', as:
+#
+#   clusters_info = {'radius': 60, 'max_zoom': 14, 'markers': ..., 'photos': ...}
+#   clusters_dict = {
+#     '0': [[longitude, latitude, markers, photos, cell x, cell y], ...],
+#     ...
+#   }
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+import math
+
+from atomic_file import AtomicFile
+
+
+# ================= CONFIGURATION VARIABLES =====================
+
+# Width of the cells in pixels (tiles of 256 pixels)
+default_radius = 60
+
+# Last zoom with clusters, markers are shown from the next one
+default_max_zoom = 14
+
+
+# ===============================================================
+
+max_latitude = 85.0511287798
+
+# Get the position on Web Mercator projection, from 0 to 1 on both axes
+def projectPosition(longitude, latitude):
+    latitude = max(-max_latitude, min(max_latitude, latitude))
+    x = (longitude + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(latitude))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return [min(max(x, 0.0), 1.0), min(max(y, 0.0), 1.0)]
+
+
+class ClusterIndex:
+
+    def __init__(self, radius=default_radius, max_zoom=default_max_zoom):
+        self.radius = radius
+        self.max_zoom = max_zoom
+        self.n_markers = 0
+        self.n_photos = 0
+        # True if the clusters changed since they were loaded
+        self.changed = False
+        # one dictionary per zoom: (cell x, cell y) ->
+        # [sum of longitudes, sum of latitudes, markers, photos]
+        self.levels = [dict() for zoom in range(max_zoom+1)]
+
+    # Get the cell of a position on each zoom
+    def getCells(self, longitude, latitude):
+        x, y = projectPosition(longitude, latitude)
+        cells = []
+        for zoom in range(self.max_zoom+1):
+            n_cells = 256.0 * 2 ** zoom / self.radius
+            cells.append((int(x * n_cells), int(y * n_cells)))
+        return cells
+
+    # Add to the clusters 'n_markers' markers with 'n_photos' photos in
+    # a position. Negative numbers remove them, clusters left with no
+    # markers are deleted
+    def update(self, longitude, latitude, n_markers, n_photos):
+        self.n_markers += n_markers
+        self.n_photos += n_photos
+        self.changed = True
+        for zoom, cell in enumerate(self.getCells(longitude, latitude)):
+            level = self.levels[zoom]
+            cluster = level.get(cell)
+            if cluster is None:
+                cluster = [0.0, 0.0, 0, 0]
+                level[cell] = cluster
+            cluster[0] += longitude * n_markers
+            cluster[1] += latitude * n_markers
+            cluster[2] += n_markers
+            cluster[3] += n_photos
+            if cluster[2] <= 0:
+                del level[cell]
+
+    def addMarker(self, position, n_photos):
+        self.update(position[0], position[1], 1, n_photos)
+
+    def removeMarker(self, position, n_photos):
+        self.update(position[0], position[1], -1, -n_photos)
+
+    # Add (or remove, if negative) photos to a marker that stays on map
+    def addPhotos(self, position, n_photos):
+        self.update(position[0], position[1], 0, n_photos)
+
+    # Build the index from all the markers on map
+    def build(self, locations_dict):
+        for country_code in locations_dict:
+            for marker in locations_dict[country_code]:
+                self.addMarker(marker[0], len(marker[1]))
+
+    # Load the index written by a previous run, returns False if it was
+    # generated with other parameters or doesn't match the map totals
+    def load(self, clusters_info, clusters_dict, n_markers, n_photos):
+        if clusters_info.get('radius') != self.radius or clusters_info.get('max_zoom') != self.max_zoom:
+            return False
+        if clusters_info.get('markers') != n_markers or clusters_info.get('photos') != n_photos:
+            return False
+        for zoom in range(self.max_zoom+1):
+            level = self.levels[zoom]
+            for cluster in clusters_dict.get(str(zoom), []):
+                level[(cluster[4], cluster[5])] = [cluster[0] * cluster[2], cluster[1] * cluster[2], cluster[2], cluster[3]]
+        self.n_markers = n_markers
+        self.n_photos = n_photos
+        self.changed = False
+        return True
+
+    # Write the index as a javascript consumable python module
+    def writeFile(self, file_path):
+        with AtomicFile(file_path) as clusters_file:
+            clusters_file.write("clusters_info = {{'radius': {}, 'max_zoom': {}, 'markers': {}, 'photos': {}}}\n".format(self.radius, self.max_zoom, self.n_markers, self.n_photos))
+            clusters_file.write("clusters_dict = {\n")
+            for zoom in range(self.max_zoom+1):
+                clusters_file.write("  \'{}\': [\n".format(zoom))
+                level = self.levels[zoom]
+                i = 1
+                for cell in sorted(level):
+                    cluster = level[cell]
+                    clusters_file.write("    [{}, {}, {}, {}, {}, {}]".format(round(cluster[0] / cluster[2], 6), round(cluster[1] / cluster[2], 6), cluster[2], cluster[3], cell[0], cell[1]))
+                    if i < len(level):
+                        clusters_file.write(",\n")
+                    else:
+                        clusters_file.write("\n")
+                    i += 1
+                if zoom < self.max_zoom:
+                    clusters_file.write("  ],\n")
+                else:
+                    clusters_file.write("  ]\n")
+            clusters_file.write("}\n")
+        self.changed = False
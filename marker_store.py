@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+
+# Columnar store of the markers and their photos. Instead of a list of
+# lists for each marker and photo, the values are kept in typed arrays,
+# one per column, so each photo takes a few dozen bytes:
+#
+#   markers: longitude, latitude, first and last photo rows, number of
+#            photos, id on the map database (-1 if it is not there)
+#   photos:  id (int64), thumbnail server and secret, next photo row
+#
+# The photos of a marker are a linked list of rows, so photos can be
+# appended to any marker. The thumbnail url is rebuilt from the server and
+# secret; urls in another format are kept as they are. Rows of removed
+# photos are not reused, the store is built again on every run.
+#
+# The markers are handled through Marker views, that behave as the lists
+# written to 'locations.py' (marker[0] is [longitude, latitude] and
+# marker[1] the list of [id, url] of its photos), so they can be used
+# anywhere a marker list is expected:
+#
+#   store = MarkerStore()
+#   locations_dict = store.addLocations(locations_dict)
+#   marker = store.addMarker([[longitude, latitude], [[id, url], ...]])
+#   marker[1].append([id, url])
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+from array import array
+
+
+# ================= CONFIGURATION VARIABLES =====================
+
+# Format of the thumbnails urls
+thumb_url_format = 'https://live.staticflickr.com/{}/{}_{:010x}_s.jpg'
+
+
+# ===============================================================
+
+class MarkerStore:
+
+    def __init__(self):
+        # markers columns
+        self.longitude = array('d')
+        self.latitude = array('d')
+        self.first_photo = array('l')
+        self.last_photo = array('l')
+        self.n_photos = array('l')
+        self.marker_id = array('q')
+        # photos columns
+        self.photo_id = array('q')
+        self.server = array('i')
+        self.secret = array('q')
+        self.next_photo = array('l')
+        # urls not in the thumbnails format, by photo row
+        self.other_urls = dict()
+
+    def __len__(self):
+        return len(self.longitude)
+
+    # Add a marker [[longitude, latitude], [[id, url], ...]], returns its view
+    def addMarker(self, marker_info):
+        index = len(self.longitude)
+        self.longitude.append(marker_info[0][0])
+        self.latitude.append(marker_info[0][1])
+        self.first_photo.append(-1)
+        self.last_photo.append(-1)
+        self.n_photos.append(0)
+        self.marker_id.append(-1)
+        self.addPhotos(index, marker_info[1])
+        return Marker(self, index)
+
+    # Add the markers of a locations dictionary, returning
+    # the same dictionary with the views of the markers
+    def addLocations(self, locations_dict):
+        return {country_code: [self.addMarker(marker) for marker in locations_dict[country_code]] for country_code in locations_dict}
+
+    def addPhoto(self, index, photo_id, thumb_url):
+        self.addPhotos(index, [[photo_id, thumb_url]])
+
+    # Append the photos [[id, url], ...] to a marker, linking their rows
+    def addPhotos(self, index, photos):
+        first_row = len(self.photo_id)
+        row = first_row
+        for photo in photos:
+            server, secret = parseThumbUrl(photo[0], photo[1])
+            if server < 0:
+                self.other_urls[row] = photo[1]
+            self.photo_id.append(int(photo[0]))
+            self.server.append(server)
+            self.secret.append(secret)
+            row += 1
+        if row == first_row:
+            return
+        self.next_photo.extend(range(first_row+1, row+1))
+        self.next_photo[row-1] = -1
+        if self.last_photo[index] < 0:
+            self.first_photo[index] = first_row
+        else:
+            self.next_photo[self.last_photo[index]] = first_row
+        self.last_photo[index] = row-1
+        self.n_photos[index] += row - first_row
+
+    # Replace all the photos of a marker
+    def setPhotos(self, index, photos):
+        photos = [[photo[0], photo[1]] for photo in photos]
+        row = self.first_photo[index]
+        while row >= 0:
+            self.other_urls.pop(row, None)
+            row = self.next_photo[row]
+        self.first_photo[index] = -1
+        self.last_photo[index] = -1
+        self.n_photos[index] = 0
+        self.addPhotos(index, photos)
+
+    def getThumbUrl(self, row):
+        if self.server[row] < 0:
+            return self.other_urls[row]
+        return thumb_url_format.format(self.server[row], self.photo_id[row], self.secret[row])
+
+    # Yield [id, url] of the photos of a marker
+    def iterPhotos(self, index):
+        row = self.first_photo[index]
+        while row >= 0:
+            yield [str(self.photo_id[row]), self.getThumbUrl(row)]
+            row = self.next_photo[row]
+
+
+# Get [server, secret] of a thumbnail url, or [-1, 0]
+# if the url can't be rebuilt from them
+def parseThumbUrl(photo_id, thumb_url):
+    parts = thumb_url.split('/')
+    try:
+        values = [int(parts[-2]), int(parts[-1].split('_')[1], 16)]
+    except (ValueError, IndexError):
+        return [-1, 0]
+    if thumb_url != thumb_url_format.format(values[0], photo_id, values[1]):
+        return [-1, 0]
+    return values
+
+
+# View of a marker on the store
+class Marker:
+
+    __slots__ = ['store', 'index']
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __len__(self):
+        return 2
+
+    # id of the marker on the map database
+    @property
+    def id(self):
+        return self.store.marker_id[self.index]
+
+    @id.setter
+    def id(self, value):
+        self.store.marker_id[self.index] = value
+
+    def __getitem__(self, i):
+        if i == 0 or i == -2:
+            return [self.store.longitude[self.index], self.store.latitude[self.index]]
+        if i == 1 or i == -1:
+            return MarkerPhotos(self.store, self.index)
+        raise IndexError('marker index out of range')
+
+    def __setitem__(self, i, value):
+        if i == 0 or i == -2:
+            self.store.longitude[self.index] = value[0]
+            self.store.latitude[self.index] = value[1]
+        elif i == 1 or i == -1:
+            self.store.setPhotos(self.index, value)
+        else:
+            raise IndexError('marker assignment index out of range')
+
+    def __iter__(self):
+        yield self[0]
+        yield self[1]
+
+    def __repr__(self):
+        return str([self[0], list(self.store.iterPhotos(self.index))])
+
+
+# View of the photos of a marker, as a list of [id, url]
+class MarkerPhotos:
+
+    __slots__ = ['store', 'index']
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __len__(self):
+        return self.store.n_photos[self.index]
+
+    def __iter__(self):
+        return self.store.iterPhotos(self.index)
+
+    def __getitem__(self, i):
+        photos = list(self.store.iterPhotos(self.index))
+        return photos[i]
+
+    def append(self, photo):
+        self.store.addPhoto(self.index, photo[0], photo[1])
+
+    def __repr__(self):
+        return str(list(self.store.iterPhotos(self.index)))
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+# Token bucket rate limiters, one per provider (Flickr and geocoders).
+# A call reserves a token and then waits until the token is available,
+# so the same limiter can be shared by threads and by asyncio tasks:
+#
+#   getLimiter('nominatim').acquire()             # from a thread
+#   await getLimiter('flickr').acquireAsync()     # from a coroutine
+#
+# The time each call waited is accumulated per provider and can be
+# printed at the end of the run with getReport().
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+import asyncio
+import threading
+import time
+
+
+# ================= CONFIGURATION VARIABLES =====================
+
+# Rate limits per provider:
+# [requests per second, burst size]
+# Flickr allows 3600 calls per hour for each api key, so its limit is
+# kept at 1 call per second, it can be raised for keys with a bigger
+# quota (the burst adds to the calls of the hour, keep it small)
+rate_limits = {
+  'flickr': [1, 5],
+  'nominatim': [1, 1],
+  'geonames': [4, 4],
+  'mapbox': [10, 10]
+}
+
+# Limit used for providers not listed above
+default_rate_limit = [1, 1]
+
+
+# ===============================================================
+
+class TokenBucket:
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+
+    # Take a token from the bucket and return how many seconds the
+    # caller must wait for it. The bucket may go negative, which
+    # queues the following callers behind this one
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = 0.0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+            self.calls += 1
+            self.waited += wait
+            self.max_wait = max(self.max_wait, wait)
+        return wait
+
+    # Wait for a token blocking the current thread
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    # Wait for a token without blocking the event loop
+    async def acquireAsync(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def getStats(self):
+        with self.lock:
+            return [self.calls, self.waited, self.max_wait]
+
+
+limiters = dict()
+limiters_lock = threading.Lock()
+
+# Get the rate limiter of a provider, creating it on first use
+def getLimiter(provider):
+    with limiters_lock:
+        if provider not in limiters:
+            rate, burst = rate_limits.get(provider, default_rate_limit)
+            limiters[provider] = TokenBucket(provider, rate, burst)
+        return limiters[provider]
+
+# Get a summary of the waits of each provider used on the run
+def getReport():
+    report = []
+    for provider in sorted(limiters):
+        calls, waited, max_wait = limiters[provider].getStats()
+        if calls > 0:
+            report.append("Rate limit '{}': {} call(s), waited {:.1f}s (avg {:.2f}s, max {:.2f}s)".format(provider, calls, waited, waited/calls, max_wait))
+    return report
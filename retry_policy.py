@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+# Retry policy with exponential backoff, jitter and respect for the
+# Retry-After hint of the servers, plus a circuit breaker per provider.
+# When too many calls to a provider fail in a row, after all their tries,
+# its breaker opens and every call fails fast with CircuitOpenError until 'reset_timeout'
+# seconds have passed, then a single trial call decides if it closes.
+#
+#   policy = RetryPolicy(max_tries=3)
+#   location = policy.call('nominatim', geolocator.reverse, latlong)
+#   page = await policy.callAsync('flickr', client.getPhotos, user_id, page=1)
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+import asyncio
+import email.utils
+import random
+import threading
+import time
+
+
+# ================= CONFIGURATION VARIABLES =====================
+
+# Backoff (seconds)
+base_delay = 1.0
+max_delay = 60.0
+
+# Circuit breaker
+# consecutive failed calls (that used all their tries) that open the circuit
+failure_threshold = 5
+# seconds the circuit stays open before a trial call
+reset_timeout = 120
+
+
+# ===============================================================
+
+# Raised when a call is refused because the circuit is open
+class CircuitOpenError(Exception):
+
+    def __init__(self, provider, remaining):
+        Exception.__init__(self, "Circuit open for '{}', retry in {:.0f}s".format(provider, remaining))
+        self.provider = provider
+        self.remaining = remaining
+
+
+class CircuitBreaker:
+
+    def __init__(self, provider, failure_threshold=failure_threshold, reset_timeout=reset_timeout):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    # Raise CircuitOpenError if calls are not allowed now
+    def checkRequest(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or self.trial:
+                raise CircuitOpenError(self.provider, max(remaining, 0))
+            # half open, let a single trial call through
+            self.trial = True
+
+    def recordSuccess(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    # Record a failed try, only the last try of a call counts as a
+    # failure, but any failed try of the trial call opens the circuit
+    def recordFailure(self, last_try=True):
+        with self.lock:
+            if last_try:
+                self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+    def isOpen(self):
+        with self.lock:
+            return self.opened_at is not None
+
+
+breakers = dict()
+breakers_lock = threading.Lock()
+
+# Get the circuit breaker of a provider, creating it on first use
+def getBreaker(provider):
+    with breakers_lock:
+        if provider not in breakers:
+            breakers[provider] = CircuitBreaker(provider)
+        return breakers[provider]
+
+# Get the number of seconds from a Retry-After value,
+# which can be given in seconds or as an http date
+def parseRetryAfter(value):
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+
+    # 'retryable' decides which exceptions are worth another try,
+    # 'on_retry' is called as on_retry(tries, error, delay) before waiting
+    def __init__(self, max_tries=10, base_delay=base_delay, max_delay=max_delay, retryable=None, on_retry=None):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retryable = retryable
+        self.on_retry = on_retry
+
+    # Delay before the next try: exponential backoff with full jitter,
+    # unless the server told how long to wait
+    def getDelay(self, tries, error):
+        retry_after = parseRetryAfter(getattr(error, 'retry_after', None))
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (tries - 1)))
+
+    def isRetryable(self, error):
+        if isinstance(error, CircuitOpenError):
+            return False
+        if self.retryable is not None:
+            return self.retryable(error)
+        return True
+
+    # Check the outcome of a try, raising the error if there
+    # are no more tries, and return the delay before the next one.
+    # The number of tries made is kept on the error as 'tries'
+    def handleFailure(self, provider, tries, error):
+        error.tries = tries
+        if isinstance(error, CircuitOpenError):
+            raise error
+        # errors that are not worth retrying mean the provider
+        # answered, so they don't count as failures of the circuit
+        retryable = self.isRetryable(error)
+        if retryable:
+            getBreaker(provider).recordFailure(tries >= self.max_tries)
+        else:
+            getBreaker(provider).recordSuccess()
+        if not retryable or tries >= self.max_tries:
+            raise error
+        delay = self.getDelay(tries, error)
+        if self.on_retry is not None:
+            self.on_retry(tries, error, delay)
+        return delay
+
+    # Call func(*args, **kwargs) blocking the current thread between tries
+    def call(self, provider, func, *args, **kwargs):
+        breaker = getBreaker(provider)
+        for tries in range(1, self.max_tries+1):
+            try:
+                breaker.checkRequest()
+                result = func(*args, **kwargs)
+                breaker.recordSuccess()
+                return result
+            except Exception as e:
+                delay = self.handleFailure(provider, tries, e)
+            time.sleep(delay)
+
+    # Await func(*args, **kwargs) without blocking the event loop between tries
+    async def callAsync(self, provider, func, *args, **kwargs):
+        breaker = getBreaker(provider)
+        for tries in range(1, self.max_tries+1):
+            try:
+                breaker.checkRequest()
+                result = await func(*args, **kwargs)
+                breaker.recordSuccess()
+                return result
+            except Exception as e:
+                delay = self.handleFailure(provider, tries, e)
+            await asyncio.sleep(delay)
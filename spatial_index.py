@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+
+# Spatial index of points on the map, as a bucket quadtree over the
+# longitude and latitude: each node covers a rectangle and keeps up to
+# 'bucket_size' points, splitting in four when it gets more. It can be
+# bulk loaded from the markers on map (the tree is built top down,
+# partitioning the points once per level) and updated as markers are
+# added or removed, answering without a full scan:
+#
+#   index = SpatialIndex()
+#   index.load([[longitude, latitude, marker], ...])
+#   index.insert(longitude, latitude, marker)
+#   index.queryBbox(west, south, east, north)   -> [marker, ...]
+#   index.queryRadius(longitude, latitude, 25)  -> [marker, ...]
+#   index.nearest(longitude, latitude, 25)      -> [marker, distance] or None
+#
+# Distances are in meters, on an equirectangular approximation that is
+# accurate for the short distances used to merge markers. Queries don't
+# wrap around the antimeridian.
+#
+# Run the module to benchmark it:  % python3 spatial_index.py 1000000
+#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+import heapq
+import math
+
+
+# ================= CONFIGURATION VARIABLES =====================
+
+# Maximum number of points on a leaf before it is split
+bucket_size = 32
+
+# Leaves at this depth are not split, so many points
+# on the same coordinates don't make the tree deeper
+max_depth = 24
+
+
+# ===============================================================
+
+meters_per_degree = 111320.0
+
+# Distance in meters between two positions
+def getDistance(longitude_1, latitude_1, longitude_2, latitude_2):
+    dx = (longitude_2 - longitude_1) * math.cos(math.radians((latitude_1 + latitude_2) / 2))
+    dy = latitude_2 - latitude_1
+    return math.sqrt(dx * dx + dy * dy) * meters_per_degree
+
+# Bounding box [west, south, east, north] of the circle
+# with 'radius' meters around a position
+def getRadiusBbox(longitude, latitude, radius):
+    d_lat = radius / meters_per_degree
+    cos_lat = max(math.cos(math.radians(min(abs(latitude) + d_lat, 90.0))), 1e-6)
+    d_long = min(d_lat / cos_lat, 360.0)
+    return [longitude - d_long, latitude - d_lat, longitude + d_long, latitude + d_lat]
+
+
+class Node:
+
+    __slots__ = ['west', 'south', 'east', 'north', 'depth', 'points', 'children']
+
+    def __init__(self, west, south, east, north, depth):
+        self.west = west
+        self.south = south
+        self.east = east
+        self.north = north
+        self.depth = depth
+        # points as [longitude, latitude, item], None once it is split
+        self.points = []
+        # [south west, south east, north west, north east] once it is split
+        self.children = None
+
+    def getChild(self, longitude, latitude):
+        i = 0
+        if longitude >= (self.west + self.east) / 2:
+            i += 1
+        if latitude >= (self.south + self.north) / 2:
+            i += 2
+        return self.children[i]
+
+    # Split in four, moving the points to the children
+    def split(self):
+        middle_long = (self.west + self.east) / 2
+        middle_lat = (self.south + self.north) / 2
+        depth = self.depth + 1
+        self.children = [Node(self.west, self.south, middle_long, middle_lat, depth),
+                         Node(middle_long, self.south, self.east, middle_lat, depth),
+                         Node(self.west, middle_lat, middle_long, self.north, depth),
+                         Node(middle_long, middle_lat, self.east, self.north, depth)]
+        points = self.points
+        self.points = None
+        for point in points:
+            self.getChild(point[0], point[1]).points.append(point)
+
+    # Minimum distance in meters from a position to the node's rectangle
+    def getMinDistance(self, longitude, latitude):
+        return getDistance(longitude, latitude, min(max(longitude, self.west), self.east), min(max(latitude, self.south), self.north))
+
+
+class SpatialIndex:
+
+    def __init__(self, west=-180.0, south=-90.0, east=180.0, north=90.0):
+        self.root = Node(west, south, east, north, 0)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    # Add many points at once, building the tree top down
+    # if it is empty, or inserting them one by one if not
+    def load(self, points):
+        points = [[point[0], point[1], point[2]] for point in points]
+        if self.size > 0:
+            for point in points:
+                self.insert(point[0], point[1], point[2])
+            return
+        stack = [[self.root, points]]
+        while len(stack) > 0:
+            node, node_points = stack.pop()
+            if len(node_points) <= bucket_size or node.depth >= max_depth:
+                node.points = node_points
+                continue
+            middle_long = (node.west + node.east) / 2
+            middle_lat = (node.south + node.north) / 2
+            quarters = [[], [], [], []]
+            for point in node_points:
+                quarters[(point[0] >= middle_long) + 2 * (point[1] >= middle_lat)].append(point)
+            node.split()
+            for i in range(4):
+                stack.append([node.children[i], quarters[i]])
+        self.size = len(points)
+
+    def insert(self, longitude, latitude, item):
+        node = self.root
+        while node.children is not None:
+            node = node.getChild(longitude, latitude)
+        node.points.append([longitude, latitude, item])
+        if len(node.points) > bucket_size and node.depth < max_depth:
+            node.split()
+        self.size += 1
+
+    # Remove an item from the given position,
+    # returns False if it was not found there
+    def remove(self, longitude, latitude, item):
+        node = self.root
+        while node.children is not None:
+            node = node.getChild(longitude, latitude)
+        for i, point in enumerate(node.points):
+            if point[2] is item or point[2] == item:
+                del node.points[i]
+                self.size -= 1
+                return True
+        return False
+
+    # Move an item to another position
+    def move(self, longitude, latitude, item, new_longitude, new_latitude):
+        if self.remove(longitude, latitude, item):
+            self.insert(new_longitude, new_latitude, item)
+
+    # Get the points [longitude, latitude, item] inside a bounding box
+    def queryPoints(self, west, south, east, north):
+        found = []
+        stack = [self.root]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.west > east or node.east < west or node.south > north or node.north < south:
+                continue
+            if node.children is not None:
+                stack.extend(node.children)
+                continue
+            for point in node.points:
+                if west <= point[0] <= east and south <= point[1] <= north:
+                    found.append(point)
+        return found
+
+    def queryBbox(self, west, south, east, north):
+        return [point[2] for point in self.queryPoints(west, south, east, north)]
+
+    # Get the items up to 'radius' meters from a position
+    def queryRadius(self, longitude, latitude, radius):
+        return [point[2] for point in self.queryPoints(*getRadiusBbox(longitude, latitude, radius))
+                if getDistance(longitude, latitude, point[0], point[1]) <= radius]
+
+    # Get [item, distance] of the nearest point to a position, or
+    # None if there is no point up to 'max_distance' meters from it
+    def nearest(self, longitude, latitude, max_distance=None):
+        if max_distance is None:
+            max_distance = float('inf')
+        best = None
+        best_distance = max_distance
+        # nodes by distance, the search stops when
+        # the next one is farther than the best point
+        heap = [[0.0, 0, self.root]]
+        counter = 1
+        while len(heap) > 0:
+            node_distance, _, node = heapq.heappop(heap)
+            if node_distance > best_distance:
+                break
+            if node.children is None:
+                for point in node.points:
+                    distance = getDistance(longitude, latitude, point[0], point[1])
+                    if distance <= best_distance:
+                        best = point
+                        best_distance = distance
+                continue
+            for child in node.children:
+                child_distance = child.getMinDistance(longitude, latitude)
+                if child_distance <= best_distance:
+                    heapq.heappush(heap, [child_distance, counter, child])
+                    counter += 1
+        if best is None:
+            return None
+        return [best[2], best_distance]
+
+
+if __name__ == '__main__':
+
+    import random
+    import sys
+    import time
+
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    random.seed(0)
+    points = [[random.uniform(-180, 180), random.uniform(-60, 75), i] for i in range(n_points)]
+
+    index = SpatialIndex()
+    start = time.time()
+    index.load(points)
+    print("Bulk load of {} points: {:.2f}s".format(n_points, time.time() - start))
+
+    start = time.time()
+    for i in range(10000):
+        index.insert(random.uniform(-180, 180), random.uniform(-60, 75), n_points + i)
+    print("10000 inserts: {:.2f}s".format(time.time() - start))
+
+    start = time.time()
+    for i in range(10000):
+        index.nearest(random.uniform(-180, 180), random.uniform(-60, 75))
+    print("10000 nearest: {:.2f}s".format(time.time() - start))
+
+    start = time.time()
+    for i in range(10000):
+        index.queryRadius(random.uniform(-180, 180), random.uniform(-60, 75), 25000)
+    print("10000 radius queries (25 km): {:.2f}s".format(time.time() - start))
+
+    start = time.time()
+    for i in range(1000):
+        longitude, latitude = random.uniform(-180, 170), random.uniform(-60, 65)
+        index.queryBbox(longitude, latitude, longitude + 10, latitude + 10)
+    print("1000 bbox queries (10x10 degrees): {:.2f}s".format(time.time() - start))